@@ -0,0 +1,234 @@
+# coding:utf-8
+# author: jason.li
+"""
+材质目录 JSON API::
+    GET /api/materials?after=<id>&limit=<n>&category=<name|id>&root=<name|id>
+        按id的keyset分页, 返回 {"items": [...], "next": <下一页的after或null>}
+    GET /api/materials/<id>   (含 graphs: sbsar中的graph、输入参数与输出, 见matmeta.py)
+    GET /api/search?tags=a,b&any=c,d&not=e   (标签倒排索引, 见tagindex.py)
+    GET /api/tags/complete?prefix=wo
+    GET /download/<id>        .sbsar
+    GET /download/<id>/zip    .zip (sbs)
+        支持Range断点续传, .sbsar的ETag为材质md5, zip的ETag取自文件大小与修改时间
+        (sbs修改后zip会重新打包, 而md5不变), 下载次数经counters.usage缓冲后批量写入
+    GET /api/materials/popular?limit=20&category=<name|id>
+    GET /api/roots, /api/categories, /api/tags   (缓存, 见cache.py)
+    GET /api/cache/stats
+    POST /api/jobs/ingest          后台入库 (见jobs.py), 202 + 任务, 同一mat_source已有任务时 409
+    GET /api/jobs, /api/jobs/<id>  任务状态与各阶段进度
+    POST /api/jobs/<id>/cancel
+
+材质条目由 serialize.material_rows 一条SQL取出(含category/root/tags名称), 直接编码为JSON bytes,
+时间字段为 ISO 8601;
+响应带 ETag 与 Last-Modified, 客户端缓存有效时返回 304
+"""
+import os
+import hashlib
+from datetime import timezone
+from flask import Blueprint, current_app, request, jsonify, abort, send_file
+
+from extensions import db
+from models import Material, MatCategory, Root
+from tagindex import tag_index
+from counters import usage
+from cache import get_roots, get_categories, get_tags, lookup_cache
+from serialize import material_rows, dumps
+from matmeta import get_meta
+from jobs import jobs, JobConflict
+
+bp = Blueprint('api', __name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def _id_filter(model, value):
+    """model id from an id or a name, as a scalar subquery (no extra round trip)"""
+    if value.isdigit():
+        return int(value)
+    return db.session.query(model.id).filter(model.name == value.lower()).scalar_subquery()
+
+
+def _conditional(data, last_modified):
+    """json response with ETag/Last-Modified, 304 when the client copy is still valid"""
+    if isinstance(data, bytes):
+        resp = current_app.response_class(data, mimetype='application/json')
+    else:
+        resp = jsonify(data)
+    resp.set_etag(hashlib.md5(resp.get_data()).hexdigest())
+    if last_modified:
+        # Material.timestamp 为本地时间(datetime.now), Werkzeug 会把 naive datetime 当作UTC
+        resp.last_modified = last_modified.astimezone(timezone.utc)
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+@bp.route('/api/materials')
+def list_materials():
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    where = [Material.id > after]
+    category = request.args.get('category')
+    if category:
+        where.append(Material.cat_id == _id_filter(MatCategory, category))
+    root = request.args.get('root')
+    if root:
+        where.append(Material.root_id == _id_filter(Root, root))
+    # 列表页走列投影序列化(serialize.py), 不构造ORM实例
+    items = material_rows(*where, limit=limit)
+
+    next_after = items[-1]['id'] if len(items) == limit else None
+    times = [m['timestamp'] for m in items if m['timestamp']]
+    return _conditional(dumps(dict(items=items, next=next_after)), max(times) if times else None)
+
+
+@bp.route('/api/materials/popular')
+def popular_materials():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    category = request.args.get('category')
+    cat_id = None
+    if category:
+        cat_id = int(category) if category.isdigit() else \
+            db.session.query(MatCategory.id).filter(MatCategory.name == category.lower()).scalar()
+        if cat_id is None:
+            return _conditional(dumps(dict(items=[])), None)
+    ranked = usage.popular(limit, cat_id)
+    mats = {m['id']: m for m in material_rows(Material.id.in_([i for i, _ in ranked]))} if ranked else {}
+    items = []
+    for mat_id, used in ranked:
+        if mat_id in mats:
+            # 含尚未写入数据库的下载次数
+            mats[mat_id]['used_times'] = used
+            items.append(mats[mat_id])
+    return _conditional(dumps(dict(items=items)), None)
+
+
+@bp.route('/api/materials/<int:mat_id>')
+def get_material(mat_id):
+    rows = material_rows(Material.id == mat_id)
+    if not rows:
+        abort(404)
+    mat = rows[0]
+    # graph/输入/输出信息来自 mat_meta (入库时解析一次), 不读取归档
+    meta = get_meta(mat['md5'])
+    mat['graphs'] = meta['graphs'] if meta else None
+    return _conditional(dumps(mat), mat['timestamp'])
+
+
+@bp.route('/api/roots')
+def list_roots():
+    return jsonify(get_roots())
+
+
+@bp.route('/api/categories')
+def list_categories():
+    return jsonify(get_categories())
+
+
+@bp.route('/api/tags')
+def list_tags():
+    return jsonify(get_tags())
+
+
+@bp.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(lookup_cache.stats())
+
+
+@bp.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    return jsonify(items=jobs.recent(limit))
+
+
+@bp.route('/api/jobs/ingest', methods=['POST'])
+def start_ingest():
+    """json body: {"workers": 4, "incremental": true, "use_cache": true, "chunk": 100} (all optional)"""
+    try:
+        job = jobs.submit(current_app.config['MAT_SOURCE'], request.get_json(silent=True) or {})
+    except JobConflict as ex:
+        return jsonify(error=str(ex), job=ex.job), 409
+    except (ValueError, TypeError) as ex:
+        return jsonify(error=str(ex)), 400
+    return jsonify(job), 202, {'Location': '/api/jobs/%d' % job['id']}
+
+
+@bp.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@bp.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job), 202
+
+
+def _arg_list(name):
+    v = request.args.get(name, '')
+    return [t.strip() for t in v.split(',') if t.strip()]
+
+
+@bp.route('/api/search')
+def search_materials():
+    """?tags=a,b (all) &any=c,d (at least one, ranked by matches) &not=e &offset=0&limit=50"""
+    ids = tag_index.search(_arg_list('tags'), _arg_list('any'), _arg_list('not'))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    page = ids[offset:offset + limit]
+    mats = {m['id']: m for m in material_rows(Material.id.in_(page))} if page else {}
+    items = [mats[i] for i in page if i in mats]
+    return _conditional(dumps(dict(total=len(ids), offset=offset, items=items)), None)
+
+
+@bp.route('/api/tags/complete')
+def complete_tags():
+    """?prefix=wo&limit=10 -> [{"name": "wood", "count": 12}, ...]"""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PAGE_SIZE)
+    found = tag_index.complete(request.args.get('prefix', ''), limit)
+    return jsonify([dict(name=n, count=c) for n, c in found])
+
+
+def _asset_path(mat, ext):
+    rel = mat.relative_path.replace('\\', os.sep)
+    return os.path.join(current_app.config['MAT_LIBRARY'], rel, mat.name + ext)
+
+
+def _send_asset(mat, ext, etag=None):
+    """stream a material file (sendfile via wsgi.file_wrapper), with Range and a strong ETag,
+    etag None: derived from the size and mtime of the file
+    """
+    path = _asset_path(mat, ext)
+    if not os.path.isfile(path):
+        abort(404)
+    st = os.stat(path)
+    resp = send_file(path, mimetype='application/octet-stream', conditional=False)
+    resp.headers.set('Content-Disposition', 'attachment', filename=mat.name + ext)
+    resp.set_etag(etag or '%x-%x' % (st.st_size, st.st_mtime_ns))
+    resp = resp.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    # 断点续传的后续请求与304不计入下载次数
+    if request.method == 'GET' and resp.status_code in (200, 206):
+        rng = request.range
+        if rng is None or rng.ranges[0][0] == 0:
+            usage.incr(mat.id)
+    return resp
+
+
+@bp.route('/download/<int:mat_id>')
+def download_sbsar(mat_id):
+    mat = db.get_or_404(Material, mat_id)
+    return _send_asset(mat, '.sbsar', mat.md5)
+
+
+@bp.route('/download/<int:mat_id>/zip')
+def download_zip(mat_id):
+    mat = db.get_or_404(Material, mat_id)
+    if not mat.has_sbszip:
+        abort(404)
+    # zip由sbs打包, 内容可能在md5不变时改变
+    return _send_asset(mat, '.zip')
@@ -0,0 +1,104 @@
+# coding:utf-8
+"""
+入库各阶段基准测试: 生成材质库(benchmarks/synth.py), 使用本地SQLite, 结果写入JSON以便跨提交比较
+
+    python -m benchmarks.bench_ingest [--categories 5] [--materials 20] [--workers 1] [--out bench_ingest.json]
+
+阶段: scan, md5, zip, tags, thumbs, put2db (全新数据库), put2db_incremental (无变化时重跑)
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from benchmarks.synth import make_library
+
+
+def _timed(results, stage, func, *args, **kwargs):
+    t = time.perf_counter()
+    ret = func(*args, **kwargs)
+    results[stage] = round(time.perf_counter() - t, 4)
+    print(f'{stage}: {results[stage]}s', file=sys.stderr)
+    return ret
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    work = tempfile.mkdtemp(prefix='mat_bench_')
+    source = os.path.join(work, 'source')
+    # 必须在导入app之前设置
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(work, 'bench.db')
+    os.environ['MAT_SOURCE'] = source
+    os.environ['MAT_MD5_CACHE'] = os.path.join(work, 'md5cache.json')
+    os.environ['MAT_MANIFEST'] = os.path.join(work, 'manifest.json')
+    os.environ['MAT_THUMB_ROOT'] = os.path.join(work, 'thumbs')
+    import app
+    import tools
+    tools.set_quiet(args.quiet)
+
+    stages = {}
+    try:
+        count = _timed(stages, 'generate', make_library, source, args.categories, args.materials,
+                       args.sbsar_kb, args.sbs_kb, args.png_px, args.tags)
+        folders = _timed(stages, 'scan', tools.scan_mat_source, source)
+        sbsars = [f.files['.sbsar'][0] for f in folders]
+        sbss = [f.files['.sbs'][0] for f in folders if '.sbs' in f.files]
+        pngs = [(f.files['.png'][0], f.cat, f.name) for f in folders if '.png' in f.files]
+        _timed(stages, 'md5', lambda: [tools.get_md5(f) for f in sbsars])
+        _timed(stages, 'zip', tools.zip_files, sbss, args.codec, workers=args.workers)
+        _timed(stages, 'tags', lambda: [tools.get_mat_tags(f) for f in sbss + sbsars])
+        _timed(stages, 'thumbs', tools.make_thumbs, pngs, workers=args.workers)
+
+        with app.create_app().app_context():
+            app.db.create_all()
+            for f in sbss:
+                os.remove(os.path.splitext(f)[0] + '.zip')
+            shutil.rmtree(os.environ['MAT_THUMB_ROOT'])
+            tools.metrics.reset()
+            written = _timed(stages, 'put2db', tools.put2db, args.workers, incremental=True)
+            put2db_metrics = tools.metrics.report()
+            _timed(stages, 'put2db_incremental', tools.put2db, args.workers, incremental=True)
+
+        result = dict(commit=_git_commit(), time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                      python=platform.python_version(), platform=platform.platform(),
+                      params=vars(args), folders=count, written=written, seconds=stages,
+                      put2db_metrics=put2db_metrics)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result['seconds']))
+    return result
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--categories', type=int, default=5)
+    p.add_argument('--materials', type=int, default=20, help='materials per category')
+    p.add_argument('--sbsar-kb', type=int, default=256)
+    p.add_argument('--sbs-kb', type=int, default=512)
+    p.add_argument('--png-px', type=int, default=256)
+    p.add_argument('--tags', type=int, default=5, help='tags per material')
+    p.add_argument('--codec', default='lzma', help='zip codec for the zip stage')
+    p.add_argument('--workers', type=int, default=1, help='0: all cores')
+    p.add_argument('--out', default='bench_ingest.json')
+    p.add_argument('--quiet', action='store_true', help='drop per-file messages')
+    args = p.parse_args(argv)
+    args.workers = args.workers or None
+    return run(args)
+
+
+if __name__ == '__main__':
+    main()
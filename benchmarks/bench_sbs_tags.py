@@ -0,0 +1,100 @@
+# coding:utf-8
+"""
+对比 .sbs 标签提取: ET.parse 整棵树 (旧实现) vs tools.get_sbs_tags 流式解析
+
+    python -m benchmarks.bench_sbs_tags [size_mb] [position]
+
+position: 目标graph在文件中的位置, 0.0 (开头) ~ 1.0 (末尾)
+每个实现在独立子进程中运行, 以便分别统计峰值RSS
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+
+def legacy_sbs_tags(sbs, name):
+    """get_mat_tags before streaming (full ET.parse)"""
+    root = ET.parse(sbs).getroot()
+    for graph in root.iter('graph'):
+        identifier = graph.find('identifier')
+        if identifier is not None:
+            _id = identifier.get('v')
+            if _id and _id.lower() == name:
+                attributes = graph.find('attributes')
+                if attributes is not None:
+                    tags = attributes.find('tags')
+                    if tags is not None:
+                        v = tags.get('v')
+                        if v:
+                            return v.split(';')
+    return []
+
+
+def make_sbs(path, name, size_mb, position=1.0):
+    """write a fake .sbs of about size_mb MB, the graph called name placed at position"""
+    node = '<compNode><uid v="{0}"/><GUILayout><gpos v="{0} 0 0"/></GUILayout>' \
+           '<compImplementation><compFilter><filter v="blend"/></compFilter></compImplementation></compNode>'
+    graph_nodes = ''.join(node.format(i) for i in range(200))
+    graph = '<graph><identifier v="{}"/><attributes><tags v="{}"/></attributes><compNodes>%s</compNodes></graph>' \
+            % graph_nodes
+    n = max(1, size_mb * 1024 * 1024 // len(graph))
+    target = min(n - 1, int(n * position))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?><package><identifier v="pkg"/><content>')
+        for i in range(n):
+            if i == target:
+                f.write(graph.format(name, 'Foo;Bar;Baz'))
+            else:
+                f.write(graph.format('graph_%d' % i, 'other'))
+        f.write('</content></package>')
+
+
+def _run(impl, path, name):
+    import tools
+    func = legacy_sbs_tags if impl == 'legacy' else tools.get_sbs_tags
+    t = time.perf_counter()
+    tags = func(path, name)
+    seconds = time.perf_counter() - t
+    tracemalloc.start()
+    func(path, name)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    ret = dict(impl=impl, seconds=round(seconds, 4), tags=sorted(tags), py_peak_mb=round(peak / 2 ** 20, 2))
+    try:
+        import resource
+        # linux: KB, macOS: bytes
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ret['max_rss_mb'] = round(rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 2)
+    except ImportError:
+        pass
+    print(json.dumps(ret))
+
+
+def main(size_mb=50, position=1.0):
+    name = 'target_graph'
+    path = os.path.join(tempfile.mkdtemp(), '%s.sbs' % name)
+    make_sbs(path, name, size_mb, position)
+    print(f'{path} {os.path.getsize(path) / 2 ** 20:.1f} MB, position {position}')
+    results = []
+    for impl in ('legacy', 'stream'):
+        out = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_sbs_tags', '--run', impl, path, name],
+                                      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        results.append(json.loads(out.decode().strip().splitlines()[-1]))
+        print(results[-1])
+    assert results[0]['tags'] == results[1]['tags'], 'tag sets differ'
+    os.remove(path)
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+        import app  # noqa, tools需要先导入app
+        _run(*sys.argv[2:5])
+    else:
+        main(*[f(a) for f, a in zip((int, float), sys.argv[1:])])
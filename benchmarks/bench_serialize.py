@@ -0,0 +1,92 @@
+# coding:utf-8
+"""
+对比 ORM实例 + C.toDict 与 serialize.material_rows 列投影 两种方式把材质表编码为JSON
+
+    python -m benchmarks.bench_serialize [rows] [tags_per_mat] [repeat]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+
+_db_file = os.path.join(tempfile.mkdtemp(prefix='mat_bench_'), 'bench.db')
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + _db_file
+import app  # noqa, tools需要先导入app
+from app import db
+from models import Material, MatCategory, MatTag, Root, ROOT_FOLDERS, t_mat_tag
+from sqlalchemy.orm import joinedload, selectinload
+import serialize
+
+
+def fill(rows, tags_per_mat, seed=0):
+    rnd = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Root.__table__.insert(), [dict(name=n, cn_name=c) for n, c in ROOT_FOLDERS])
+    db.session.execute(MatCategory.__table__.insert(), [dict(name='cat_%d' % i) for i in range(20)])
+    db.session.execute(MatTag.__table__.insert(), [dict(name='tag_%d' % i) for i in range(300)])
+    mats, links = [], []
+    for i in range(1, rows + 1):
+        mats.append(dict(id=i, name='mat_%d' % i, cat_id=rnd.randint(1, 20), size=rnd.getrandbits(24),
+                         relative_path='cat/mat_%d/mat_%d.sbsar' % (i, i), has_sbszip=bool(i % 2),
+                         thumbnail='thumbs/mat_%d_512.jpg' % i, thumb_sizes='128,256,512',
+                         md5='%032x' % rnd.getrandbits(128), root_id=3))
+        links.extend(dict(mat_id=i, tag_id=t) for t in rnd.sample(range(1, 301), tags_per_mat))
+    db.session.execute(Material.__table__.insert(), mats)
+    db.session.execute(t_mat_tag.insert(), links)
+    db.session.commit()
+
+
+def orm_todict():
+    mats = (Material.query.options(joinedload(Material.category), joinedload(Material.root),
+                                   selectinload(Material.tags))
+            .order_by(Material.id).all())
+    items = []
+    for mat in mats:
+        d = mat.toDict()
+        d['category'] = mat.category.name if mat.category else None
+        d['root'] = mat.root.name if mat.root else None
+        d['tags'] = sorted(t.name for t in mat.tags)
+        items.append(d)
+    return json.dumps(items, default=str).encode('utf-8')
+
+
+def projected():
+    return serialize.dumps(serialize.material_rows())
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        t = time.perf_counter()
+        data = func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    db.session.expunge_all()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dict(seconds=round(best, 4), peak_mb=round(peak / 2 ** 20, 2), bytes=len(data))
+
+
+def main(rows=10000, tags_per_mat=6, repeat=3):
+    with app.create_app().app_context():
+        fill(rows, tags_per_mat)
+        report = dict(rows=rows, tags_per_mat=tags_per_mat,
+                      encoder='orjson' if serialize.orjson else 'json',
+                      toDict=measure(orm_todict, repeat),
+                      projected=measure(projected, repeat))
+        report['speedup'] = round(report['toDict']['seconds'] / max(report['projected']['seconds'], 1e-9), 2)
+        print(json.dumps(report, indent=2))
+        db.session.remove()
+    os.remove(_db_file)
+    return report
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:4]])
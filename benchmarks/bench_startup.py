@@ -0,0 +1,74 @@
+# coding:utf-8
+"""
+web进程冷启动基准: 每种方式在新的子进程中执行, 取多次中的最小值
+
+    python -m benchmarks.bench_startup [repeat]
+
+    web     create_app()                   web worker 实际导入的模块
+    ingest  create_app() + import tools    改为工厂前每个worker都要导入的模块(py7zr, zipfile, ElementTree...)
+
+每项记录: 总耗时, -X importtime 统计的导入耗时(self合计), 最慢的几个顶层导入, 子进程峰值RSS
+"""
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('py7zr', 'zipfile', 'xml.etree.ElementTree', 'PIL', 'concurrent.futures.process', 'tools')
+
+MODES = {
+    'web': 'import app; app.create_app()',
+    'ingest': 'import app; app.create_app(); import tools',
+}
+
+_PROBE = '''
+import sys, time, json, resource
+t = time.perf_counter()
+%s
+t = time.perf_counter() - t
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps(dict(seconds=t, rss_kb=rss if sys.platform != 'darwin' else rss // 1024,
+                      heavy=[m for m in %r if m in sys.modules])))
+'''
+
+
+def parse_importtime(stderr, top=5):
+    """(sum of self us, [(cumulative us, module)] of the slowest top level imports)"""
+    total, roots = 0, []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        if not name[1:].startswith(' '):
+            roots.append((int(cum_us), name.strip()))
+    return total, sorted(roots, reverse=True)[:top]
+
+
+def measure(code, repeat=5):
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI='sqlite://')
+    best = None
+    for _ in range(repeat):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE % (code, HEAVY)],
+                           cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+        r = json.loads(p.stdout.strip().splitlines()[-1])
+        r['import_us'], r['slowest'] = parse_importtime(p.stderr)
+        if best is None or r['seconds'] < best['seconds']:
+            best = r
+    best['seconds'] = round(best['seconds'], 4)
+    return best
+
+
+def main(repeat=5):
+    report = {name: measure(code, repeat) for name, code in MODES.items()}
+    web, ingest = report['web'], report['ingest']
+    report['saved'] = dict(seconds=round(ingest['seconds'] - web['seconds'], 4),
+                           import_us=ingest['import_us'] - web['import_us'],
+                           rss_kb=ingest['rss_kb'] - web['rss_kb'])
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,61 @@
+# coding:utf-8
+"""
+对比各压缩算法打包 .sbs 的吞吐量(MB/s)与压缩率
+
+    python -m benchmarks.bench_zip [files] [size_mb] [workers]
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+import app  # noqa, tools需要先导入app
+import tools
+
+
+def make_sbs_files(folder, count, size_mb, seed=0):
+    """fake .sbs xml files, repetitive like real node graphs but not trivially compressible"""
+    rnd = random.Random(seed)
+    files = []
+    for i in range(count):
+        path = os.path.join(folder, 'mat_%d.sbs' % i)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?><package><content>')
+            written = 0
+            while written < size_mb * 2 ** 20:
+                node = '<compNode><uid v="%d"/><gpos v="%.4f %.4f 0"/><filter v="%s"/></compNode>' % (
+                    rnd.getrandbits(31), rnd.uniform(-1e3, 1e3), rnd.uniform(-1e3, 1e3),
+                    rnd.choice(('blend', 'levels', 'warp', 'transformation', 'uniform')))
+                f.write(node)
+                written += len(node)
+            f.write('</content></package>')
+        files.append(path)
+    return files
+
+
+def main(count=8, size_mb=8, workers=None):
+    folder = tempfile.mkdtemp()
+    try:
+        files = make_sbs_files(folder, count, size_mb)
+        reports = []
+        for codec in tools.ZIP_CODECS:
+            for f in os.listdir(folder):
+                if f.endswith('.zip'):
+                    os.remove(os.path.join(folder, f))
+            zips, report = tools.zip_files(files, codec, workers=workers)
+            assert all(zips), 'zip failed'
+            reports.append(report)
+            print(json.dumps(report))
+        return reports
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    if len(sys.argv) > 3:
+        args.append(int(sys.argv[3]) or None)
+    main(*args)
@@ -0,0 +1,84 @@
+# coding:utf-8
+"""
+生成测试用的材质库 (目录结构同 tools.py 入库设计)::
+
+    {root}/{cat}/{name}/{name}.sbsar   7z, 含 {name}.xml 描述 (graph pkgurl/keywords) 与二进制数据
+    {root}/{cat}/{name}/{name}.sbs     xml, 含 identifier 为 {name} 的 graph 及 tags
+    {root}/{cat}/{name}/{name}.png     缩略图
+
+    python -m benchmarks.synth <root> [categories] [materials_per_category]
+"""
+import os
+import sys
+import zlib
+import random
+import struct
+
+import py7zr
+
+TAG_WORDS = ['wood', 'metal', 'stone', 'fabric', 'leather', 'plastic', 'ceramic', 'concrete', 'ground', 'organic',
+             'rough', 'smooth', 'painted', 'rusty', 'dirty', 'clean', 'old', 'new', 'pattern', 'tiles', 'brick',
+             'marble', 'oak', 'pine', 'gold', 'silver', 'copper', 'sand', 'moss', 'bark']
+
+
+def _png(width, height, rnd):
+    """a valid rgb png, noisy so it does not compress to nothing"""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + rnd.randbytes(width * 3) for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b'')
+
+
+def _sbs(name, tags, size_kb, rnd):
+    node = '<compNode><uid v="%d"/><GUILayout><gpos v="%d %d 0"/></GUILayout></compNode>'
+    nodes = []
+    written = 0
+    while written < size_kb * 1024:
+        nodes.append(node % (rnd.getrandbits(31), rnd.randint(-999, 999), rnd.randint(-999, 999)))
+        written += len(nodes[-1])
+    half = len(nodes) // 2
+    return ('<?xml version="1.0" encoding="UTF-8"?><package><identifier v="%s"/><content>'
+            '<graph><identifier v="%s_helper"/><compNodes>%s</compNodes></graph>'
+            '<graph><identifier v="%s"/><attributes><tags v="%s"/></attributes><compNodes>%s</compNodes></graph>'
+            '</content></package>') % (name, name, ''.join(nodes[:half]), name, ';'.join(tags), ''.join(nodes[half:]))
+
+
+def _sbsar_xml(name, tags):
+    return ('<?xml version="1.0" encoding="UTF-8"?><sbsdescription><graphs>'
+            '<graph pkgurl="pkg://%s" label="%s" keywords="%s">'
+            '<inputs><input identifier="$outputsize" type="int2"/><input identifier="roughness" type="float1"/></inputs>'
+            '<outputs><output identifier="basecolor"/><output identifier="normal"/><output identifier="roughness"/>'
+            '</outputs></graph></graphs></sbsdescription>') % (name, name, ';'.join(tags))
+
+
+def make_library(root, categories=5, materials=20, sbsar_kb=256, sbs_kb=512, png_px=256, tags=5,
+                 sbs_ratio=0.5, png_ratio=0.95, seed=0):
+    """write categories x materials material folders under root, return the number of folders.
+    sbs_ratio/png_ratio: share of folders that have a .sbs / .png (the rest test the error paths)
+    """
+    rnd = random.Random(seed)
+    count = 0
+    for c in range(categories):
+        cat = 'cat%03d' % c
+        for m in range(materials):
+            name = '%s_mat%05d' % (cat, m)
+            fd = os.path.join(root, cat, name)
+            os.makedirs(fd, exist_ok=True)
+            mat_tags = rnd.sample(TAG_WORDS, min(tags, len(TAG_WORDS)))
+            with py7zr.SevenZipFile(os.path.join(fd, name + '.sbsar'), 'w') as z:
+                z.writestr(_sbsar_xml(name, mat_tags), name + '.xml')
+                z.writestr(rnd.randbytes(sbsar_kb * 1024), name + '.sbsasm')
+            if rnd.random() < sbs_ratio:
+                with open(os.path.join(fd, name + '.sbs'), 'w', encoding='utf-8') as f:
+                    f.write(_sbs(name, mat_tags, sbs_kb, rnd))
+            if rnd.random() < png_ratio:
+                with open(os.path.join(fd, name + '.png'), 'wb') as f:
+                    f.write(_png(png_px, png_px, rnd))
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    print(make_library(args[0], *[int(a) for a in args[1:3]]))
@@ -0,0 +1,100 @@
+# coding:utf-8
+# author: jason.li
+"""
+导航类查询的缓存 (read-through, LRU + TTL)::
+    Root 导航、MatCategory 与 MatTag 列表几乎不变, 缓存其 toDict 结果
+    put2db 新增分类/标签、initRoot 执行后自动失效;
+    其他进程的修改最多 TTL 秒后可见
+
+    from cache import get_roots, get_categories, get_tags, lookup_cache
+    lookup_cache.stats()
+"""
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from models import Root, MatCategory, MatTag
+
+CACHE_SIZE = 128
+CACHE_TTL = 300
+
+
+class TTLCache(object):
+    """thread safe LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            e = self._data.get(key)
+            if e is not None and (not self.ttl or time.time() - e[0] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return e[1]
+            if e is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """drop one key, or everything when key is None"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._data), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits,
+                        misses=self.misses, invalidations=self.invalidations)
+
+
+lookup_cache = TTLCache()
+_missing = object()
+
+
+def read_through(key):
+    """cache the result of a no-argument lookup under key"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper():
+            value = lookup_cache.get(key, _missing)
+            if value is _missing:
+                value = func()
+                lookup_cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
+
+
+@read_through('roots')
+def get_roots():
+    """Root navigation in ROOT_FOLDERS order, [toDict()]"""
+    return [r.toDict() for r in Root.query.order_by(Root.id)]
+
+
+@read_through('categories')
+def get_categories():
+    return [c.toDict() for c in MatCategory.query.order_by(MatCategory.name)]
+
+
+@read_through('tags')
+def get_tags():
+    return [t.toDict() for t in MatTag.query.order_by(MatTag.name)]
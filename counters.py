@@ -0,0 +1,172 @@
+# coding:utf-8
+# author: jason.li
+"""
+Material.used_times 计数缓冲 (write-behind)::
+    下载请求只在内存中累加 (usage.incr(mat_id)), 不直接写数据库;
+    每 FLUSH_SECONDS 秒, 或待写入次数达到 FLUSH_SIZE 时, 由后台线程合并为一次批量 UPDATE;
+    进程正常退出时再写入一次, 写入失败则保存到本进程的 spill 文件 ({spill}.{pid}-{time_ns}),
+    下次启动时合并载入; 多个web进程同时启动时, 每个 spill 文件先改名认领, 只会被一个进程载入
+
+    usage.popular(20)  # 下载最多的材质 [(id, used_times)], 包含尚未写入数据库的次数
+"""
+import os
+import re
+import glob
+import json
+import time
+import atexit
+import threading
+
+from extensions import db
+from models import Material
+
+FLUSH_SIZE = 100
+FLUSH_SECONDS = 10
+spill_file = os.getenv('MAT_USAGE_SPILL', 'usage_spill.json')
+
+
+class UsageCounter(object):
+    """in-process buffer of used_times increments per material id"""
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_seconds=FLUSH_SECONDS, spill=spill_file):
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.spill = spill
+        self.flushed = 0
+        self._pending = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        self.app = None
+        self._load_spill()
+
+    def init_app(self, app):
+        """app whose context the background flush runs in (see create_app)"""
+        self.app = app
+
+    def _spill_files(self):
+        """spill files left by exited processes (and the single file of older versions)"""
+        found = [p for p in glob.glob(glob.escape(self.spill) + '.*')
+                 if re.fullmatch(r'\d+-\d+', p[len(self.spill) + 1:])]
+        if os.path.exists(self.spill):
+            found.append(self.spill)
+        return found
+
+    def _load_spill(self):
+        if not self.spill:
+            return
+        for path in self._spill_files():
+            # 改名认领, 其他进程已认领时改名失败
+            claimed = '%s.%d.loading' % (path, os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed, 'r', encoding='utf-8') as f:
+                    self._restore({int(k): v for k, v in json.load(f).items()})
+                os.remove(claimed)
+            except (OSError, ValueError) as ex:
+                print(f'[USAGE] cannot load {claimed}: {ex}')
+
+    def incr(self, mat_id, n=1):
+        with self._lock:
+            self._pending[mat_id] = self._pending.get(mat_id, 0) + n
+            self._total += n
+            full = self._total >= self.flush_size
+        self._ensure_timer()
+        if full:
+            threading.Thread(target=self._flush_in_app, daemon=True).start()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending, self._total = self._pending, {}, 0
+        return pending
+
+    def _restore(self, pending):
+        with self._lock:
+            for mat_id, n in pending.items():
+                self._pending[mat_id] = self._pending.get(mat_id, 0) + n
+                self._total += n
+
+    def flush(self):
+        """write pending increments with one executemany UPDATE, return the number of rows"""
+        with self._flushing:
+            pending = self._take()
+            if not pending:
+                return 0
+            t = Material.__table__
+            # 显式保留 timestamp, 否则 onupdate 会把计数当作修改 (TagIndex 整体重建, Last-Modified 变化)
+            stmt = t.update().where(t.c.id == db.bindparam('mat_id')) \
+                .values(used_times=db.func.coalesce(t.c.used_times, 0) + db.bindparam('n'),
+                        timestamp=t.c.timestamp)
+            try:
+                db.session.execute(stmt, [dict(mat_id=k, n=v) for k, v in sorted(pending.items())])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self._restore(pending)
+                raise
+            self.flushed += len(pending)
+            return len(pending)
+
+    def _flush_in_app(self):
+        if self.app is None:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception as ex:
+                print(f'[USAGE] flush failed, keep counts: {ex}')
+
+    def _ensure_timer(self):
+        if self._timer is not None or not self.flush_seconds:
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._run_timer, name='usage-flush', daemon=True)
+                self._timer.start()
+
+    def _run_timer(self):
+        while not self._stop.wait(self.flush_seconds):
+            if self._total:
+                self._flush_in_app()
+
+    def close(self):
+        """stop the timer and flush, counts that cannot be written go to the spill file"""
+        self._stop.set()
+        self._flush_in_app()
+        pending = self.pending()
+        if pending and self.spill:
+            # 每个进程写自己的文件, 不覆盖其他进程的计数
+            path = '%s.%d-%d' % (self.spill, os.getpid(), time.time_ns())
+            tmp = '%s.tmp' % path
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(pending, f)
+            os.replace(tmp, path)
+            print(f'[USAGE] {len(pending)} counts saved to {path}')
+
+    def popular(self, limit=20, cat_id=None):
+        """[(material id, used_times)] most used first, used_times includes pending counts"""
+        pending = self.pending()
+        q = db.session.query(Material.id, Material.used_times)
+        if cat_id is not None:
+            q = q.filter(Material.cat_id == cat_id)
+        # 候选: 数据库中的前limit个 + 有待写入次数的材质
+        top = dict(q.order_by(Material.used_times.desc(), Material.id).limit(limit))
+        extra = [i for i in pending if i not in top]
+        if extra:
+            top.update(q.filter(Material.id.in_(extra)))
+        ranked = sorted(((i, (used or 0) + pending.get(i, 0)) for i, used in top.items()),
+                        key=lambda x: (-x[1], x[0]))
+        return ranked[:limit]
+
+
+usage = UsageCounter()
+atexit.register(usage.close)
@@ -0,0 +1,18 @@
+# coding:utf-8
+# author: jason.li
+"""
+flask 扩展实例::
+    app.py、models.py 及各服务模块都从这里导入 db, 不依赖 app 模块的导入顺序
+    (python app.py 运行时 app.py 是 __main__, models 从 app 导入会形成循环导入并得到另一份 db)
+    from app import db 仍然可用
+"""
+from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
+
+db = SQLAlchemy()
+# 用于迁移数据库(当表结构发生变更时,不破坏原有数据)
+# 基本步骤:
+# flask db init (创建迁移环境,只需执行一次)
+# flask db migrate -m "add note timestamp" (生成迁移脚本)
+# flask db upgrade (执行更新)
+migrate = Migrate()
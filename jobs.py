@@ -0,0 +1,341 @@
+# coding:utf-8
+# author: jason.li
+"""
+后台入库任务队列::
+    任务状态与各阶段进度保存在本地SQLite文件(MAT_JOBS_DB, 默认jobs.db), 多个web进程共享;
+    任务在接收请求的进程内由有界线程池执行 (put2db 的 CPU 阶段仍使用其自身的进程池),
+    请求线程只负责登记任务并立即返回
+    同一 mat_source 同时只能有一个 queued/running 任务 (部分唯一索引保证, 跨进程有效);
+    所属进程已退出的任务在首次连接及登记冲突时标记为 failed (interrupted), 不会一直占用 mat_source
+    取消: 设置cancel标记, 运行中的任务在各阶段处理过程中(最多约 PROGRESS_SECONDS 秒)检查并停止 (已写入的批次保留)
+
+    jobs.submit(source, params)   -> job dict, 冲突时抛出 JobConflict
+    jobs.get(job_id), jobs.cancel(job_id), jobs.recent()
+    state: queued -> running -> done | failed | cancelled
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+jobs_file = os.getenv('MAT_JOBS_DB', 'jobs.db')
+JOB_WORKERS = 1
+# 进度写入与取消检查的最小间隔(秒)
+PROGRESS_SECONDS = 1.0
+_BOOLS = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False}
+
+
+def _bool_param(v):
+    """JSON boolean, or one of the strings in _BOOLS (bool('false') would be True)"""
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.strip().lower() in _BOOLS:
+        return _BOOLS[v.strip().lower()]
+    raise ValueError('expected true or false, got %r' % (v,))
+
+
+def _int_param(low):
+    """integer (or integer string) >= low; floats and booleans are rejected"""
+    def convert(v):
+        if isinstance(v, bool) or not isinstance(v, (int, str)):
+            raise ValueError('expected an integer, got %r' % (v,))
+        v = int(v)
+        if v < low:
+            raise ValueError('must be >= %d, got %d' % (low, v))
+        return v
+    return convert
+
+
+# 允许通过接口传入的 put2db 参数; workers 0 表示全部核心, 超过核心数按核心数
+INGEST_PARAMS = {'workers': _int_param(0), 'use_cache': _bool_param, 'incremental': _bool_param,
+                 'chunk': _int_param(1)}
+# Windows API 常量, 见_win_pid_alive
+_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+_STILL_ACTIVE = 259
+_ERROR_ACCESS_DENIED = 5
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    params TEXT,
+    state TEXT NOT NULL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_active_source ON jobs (source) WHERE state IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS ix_jobs_created ON jobs (created);
+'''
+
+
+class JobConflict(Exception):
+    """another ingest over the same source is queued or running"""
+
+    def __init__(self, job):
+        super().__init__('job %s is %s for %s' % (job['id'], job['state'], job['source']))
+        self.job = job
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def ingest_params(raw):
+    """put2db keyword arguments from request/CLI values, ValueError on unknown or invalid ones"""
+    params = {}
+    for k, v in (raw or {}).items():
+        if k not in INGEST_PARAMS:
+            raise ValueError('unknown parameter %r' % k)
+        if v is not None:
+            try:
+                v = INGEST_PARAMS[k](v)
+            except ValueError as ex:
+                raise ValueError('invalid %s: %s' % (k, ex))
+        if k == 'workers':
+            v = min(v, os.cpu_count() or 1) if v else None
+        params[k] = v
+    return params
+
+
+def _win_pid_alive(pid):
+    """Windows: os.kill(pid, 0) sends CTRL_C_EVENT and succeeds for any pid, ask the process itself"""
+    import ctypes
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    handle = kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # 进程存在但无权访问
+        return ctypes.get_last_error() == _ERROR_ACCESS_DENIED
+    try:
+        code = ctypes.c_ulong()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True
+        return code.value == _STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return _win_pid_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+def _row(row):
+    if row is None:
+        return None
+    d = dict(row)
+    for k in ('params', 'progress', 'result'):
+        d[k] = json.loads(d[k]) if d[k] else None
+    d['cancel'] = bool(d['cancel'])
+    return d
+
+
+class JobQueue(object):
+    """sqlite backed job table + a bounded thread pool running the jobs of this process"""
+
+    def __init__(self, path=jobs_file, workers=JOB_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.app = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def init_app(self, app):
+        """app whose context the jobs run in (see create_app)"""
+        self.app = app
+        self.path = app.config.get('MAT_JOBS_DB', self.path)
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.executescript(_SCHEMA)
+                    self._recover(conn)
+                    self._ready = True
+        return conn
+
+    def _recover(self, conn):
+        """jobs left active by a process that no longer exists can never finish, return how many were failed"""
+        count = 0
+        for r in conn.execute("SELECT id, pid FROM jobs WHERE state IN ('queued', 'running')").fetchall():
+            if r['pid'] and not _pid_alive(r['pid']):
+                conn.execute("UPDATE jobs SET state='failed', error='interrupted', finished=? WHERE id=?",
+                             (time.time(), r['id']))
+                count += 1
+        return count
+
+    def _update(self, job_id, **values):
+        cols = ', '.join('%s=?' % k for k in values)
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE jobs SET %s WHERE id=?' % cols, list(values.values()) + [job_id])
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            return _row(conn.execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone())
+        finally:
+            conn.close()
+
+    def recent(self, limit=20):
+        conn = self._connect()
+        try:
+            return [_row(r) for r in conn.execute('SELECT * FROM jobs ORDER BY created DESC LIMIT ?', (limit,))]
+        finally:
+            conn.close()
+
+    def active(self, source):
+        conn = self._connect()
+        try:
+            return _row(conn.execute("SELECT * FROM jobs WHERE source=? AND state IN ('queued', 'running')",
+                                     (source,)).fetchone())
+        finally:
+            conn.close()
+
+    def create(self, source, params=None, kind='ingest'):
+        """register a queued job owned by this process, raise JobConflict if source is busy
+        (ValueError for invalid params, see ingest_params)
+        """
+        source = os.path.abspath(source)
+        params = json.dumps(ingest_params(params))
+        conn = self._connect()
+        try:
+            # 冲突时先清理进程已退出的任务再重试一次 (该进程可能在本进程启动之后才退出)
+            for retry in (True, False):
+                try:
+                    cur = conn.execute('INSERT INTO jobs (kind, source, params, state, pid, created) '
+                                       'VALUES (?, ?, ?, ?, ?, ?)',
+                                       (kind, source, params, 'queued', os.getpid(), time.time()))
+                    break
+                except sqlite3.IntegrityError:
+                    if not (retry and self._recover(conn)):
+                        busy = self.active(source)
+                        raise JobConflict(busy or dict(id=None, state='running', source=source))
+            job_id = cur.lastrowid
+        finally:
+            conn.close()
+        return self.get(job_id)
+
+    def submit(self, source, params=None):
+        """queue an ingest of source and run it in the background, return the job"""
+        job = self.create(source, params)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ingest-job')
+        self._pool.submit(self._run_in_app, job['id'])
+        return job
+
+    @contextmanager
+    def holding(self, source, kind, params=None):
+        """a running job of kind for source while the block runs in this thread (e.g. watch mode),
+        so other ingests of source are refused; the block polls job['id'] for cancel itself
+        """
+        job = self.create(source, params, kind=kind)
+        self._update(job['id'], state='running', started=time.time())
+        state, error = 'done', None
+        try:
+            yield job
+        except KeyboardInterrupt:
+            state = 'cancelled'
+        except Exception as ex:
+            state, error = 'failed', '%s: %s' % (type(ex).__name__, ex)
+            raise
+        finally:
+            if state == 'done' and self.get(job['id'])['cancel']:
+                state = 'cancelled'
+            self._update(job['id'], state=state, error=error, finished=time.time())
+
+    def cancel(self, job_id):
+        """queued jobs are cancelled at once, running ones stop at the next progress check"""
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE jobs SET state='cancelled', cancel=1, finished=? WHERE id=? AND state='queued'",
+                         (time.time(), job_id))
+            conn.execute("UPDATE jobs SET cancel=1 WHERE id=? AND state='running'", (job_id,))
+        finally:
+            conn.close()
+        return self.get(job_id)
+
+    def _run_in_app(self, job_id):
+        with self.app.app_context():
+            self.run(job_id)
+
+    def run(self, job_id, echo=None):
+        """run a queued ingest job in this thread (needs an app context), return the final job"""
+        conn = self._connect()
+        try:
+            # 只有仍处于queued(未被取消)的任务才开始
+            started = conn.execute("UPDATE jobs SET state='running', started=?, pid=? WHERE id=? AND state='queued'",
+                                   (time.time(), os.getpid(), job_id)).rowcount
+        finally:
+            conn.close()
+        job = self.get(job_id)
+        if not started:
+            return job
+        import tools
+        from metrics import metrics
+        base = metrics.report()['stages']
+        done = dict(checked=0, written=0)
+        last = [0.0]
+
+        def snapshot():
+            """checked/written counts and items/bytes/seconds of each ingest stage since the job started"""
+            stages = {}
+            for stage, m in metrics.report()['stages'].items():
+                b = base.get(stage, {})
+                stages[stage] = dict(items=m['items'] - b.get('items', 0), bytes=m['bytes'] - b.get('bytes', 0),
+                                     seconds=round(m['seconds'] - b.get('seconds', 0), 3))
+            return json.dumps(dict(done, stages=stages))
+
+        def progress(checked, written):
+            done.update(checked=checked, written=written)
+            now = time.time()
+            if now - last[0] < PROGRESS_SECONDS:
+                return
+            last[0] = now
+            self._update(job_id, progress=snapshot())
+            if echo:
+                echo('checked %d, written %d' % (checked, written))
+            if self.get(job_id)['cancel']:
+                raise JobCancelled()
+
+        params = job['params']
+        error = None
+        try:
+            tools.put2db(source=job['source'], progress=progress, **params)
+            state = 'done'
+        except JobCancelled:
+            state = 'cancelled'
+        except Exception as ex:
+            tools.db.session.rollback()
+            state, error = 'failed', '%s: %s' % (type(ex).__name__, ex)
+            print(f'[JOB {job_id}] {error}')
+        self._update(job_id, state=state, progress=snapshot(), result=json.dumps(dict(written=done['written'])),
+                     error=error, finished=time.time())
+        return self.get(job_id)
+
+
+jobs = JobQueue()
@@ -0,0 +1,74 @@
+# coding:utf-8
+# author: jason.li
+"""
+材质元数据 sidecar (mat_meta 表, 以 .sbsar 的 md5 为键)::
+    入库时 .sbsar 中的xml只解析一次 (tools.read_sbsar_meta):
+        {"v": META_VERSION, "graphs": [{"pkgurl", "label", "category", "keywords",
+                                        "inputs": [{"identifier", "type", "label"}],
+                                        "outputs": [{"identifier", "label", "usages"}]}]}
+    以 zlib 压缩的JSON保存; md5 相同即内容相同, 记录不会过期, 只有 META_VERSION 变化时视为缺失
+    之后的标签读取、重新入库与 API 详情都从这里读取, 不再解压归档
+
+    from matmeta import load_meta, meta_tags
+"""
+import json
+import zlib
+
+from extensions import db
+from models import MatMeta
+
+# 解析内容变化时加1, 旧版本记录会被重新解析覆盖
+META_VERSION = 1
+_IN_BATCH = 500
+
+
+def pack(meta):
+    return zlib.compress(json.dumps(meta, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def unpack(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def load_meta(md5s):
+    """{md5: meta} of the stored md5s, records of another META_VERSION are left out"""
+    md5s = sorted(set(m for m in md5s if m))
+    ret = {}
+    for i in range(0, len(md5s), _IN_BATCH):
+        q = db.session.query(MatMeta.md5, MatMeta.data) \
+            .filter(MatMeta.md5.in_(md5s[i:i + _IN_BATCH]), MatMeta.version == META_VERSION)
+        for md5, data in q:
+            ret[md5] = unpack(data)
+    return ret
+
+
+def get_meta(md5):
+    return load_meta([md5]).get(md5) if md5 else None
+
+
+def save_meta(packed):
+    """packed: {md5: pack(meta)}, replaces existing records, the caller commits"""
+    if not packed:
+        return 0
+    md5s = sorted(packed)
+    t = MatMeta.__table__
+    for i in range(0, len(md5s), _IN_BATCH):
+        db.session.execute(t.delete().where(t.c.md5.in_(md5s[i:i + _IN_BATCH])))
+    db.session.execute(t.insert(), [dict(md5=m, version=META_VERSION, data=packed[m]) for m in md5s])
+    return len(md5s)
+
+
+def main_graph(meta, name):
+    """the graph whose pkgurl ends with name (pkgurl = "pkg://ceramic_foam_geometric")"""
+    for g in meta.get('graphs', ()):
+        if (g.get('pkgurl') or '').endswith(name):
+            return g
+    return None
+
+
+def meta_tags(meta, name):
+    """keywords of the main graph, the same tags get_mat_tags reads from the .sbsar"""
+    g = main_graph(meta, name)
+    if not g:
+        return []
+    return sorted(set(k.lower() for k in g.get('keywords', ()) if k))
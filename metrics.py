@@ -0,0 +1,175 @@
+# coding:utf-8
+# author: jason.li
+"""
+入库各阶段的计数、字节数与耗时直方图::
+
+    from metrics import metrics
+    with metrics.timer('hash', nbytes=size):
+        ...
+    metrics.observe('zip', seconds, nbytes=size)
+    metrics.report()        # dict (json)
+    metrics.to_prometheus() # Prometheus text format
+    metrics.save('ingest.prom')
+    base = metrics.snapshot(); ...; metrics.since(base).report()   # 只统计这段时间(例如一次put2db)
+
+工作进程中的耗时由主进程汇总(工作进程返回耗时, 主进程调用 observe)
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# 耗时直方图的桶(秒)
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        h = Histogram()
+        h.counts = list(self.counts)
+        h.sum = self.sum
+        h.count = self.count
+        return h
+
+    def minus(self, other):
+        """observations since other (an earlier copy), None when there are none"""
+        if other is None:
+            return self.copy()
+        if self.count == other.count:
+            return None
+        h = Histogram()
+        h.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        h.sum = self.sum - other.sum
+        h.count = self.count - other.count
+        return h
+
+    def cumulative(self):
+        """[(le, count)] including +Inf"""
+        ret = []
+        total = 0
+        for le, c in zip(BUCKETS + ('+Inf',), self.counts):
+            total += c
+            ret.append((le, total))
+        return ret
+
+
+class Metrics(object):
+    """per-stage items, bytes and latency histogram (thread safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._items = {}
+            self._bytes = {}
+            self._hist = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def observe(self, stage, seconds, nbytes=0, items=1):
+        with self._lock:
+            self._items[stage] = self._items.get(stage, 0) + items
+            self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+            h = self._hist.get(stage)
+            if h is None:
+                h = self._hist[stage] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name, n=1):
+        """plain counter, e.g. hash_cache_hits"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def snapshot(self):
+        """copy of the current values, see since()"""
+        m = Metrics()
+        with self._lock:
+            m._items = dict(self._items)
+            m._bytes = dict(self._bytes)
+            m._hist = {k: h.copy() for k, h in self._hist.items()}
+            m._counters = dict(self._counters)
+        return m
+
+    def since(self, base):
+        """Metrics of what was recorded after base (a snapshot()), e.g. of one put2db in a long running process"""
+        m = Metrics()
+        m.started = base.started
+        with self._lock:
+            for stage, h in self._hist.items():
+                h = h.minus(base._hist.get(stage))
+                if h is not None:
+                    m._hist[stage] = h
+                    m._items[stage] = self._items[stage] - base._items.get(stage, 0)
+                    m._bytes[stage] = self._bytes[stage] - base._bytes.get(stage, 0)
+            for name, v in self._counters.items():
+                if v != base._counters.get(name, 0):
+                    m._counters[name] = v - base._counters.get(name, 0)
+        return m
+
+    @contextmanager
+    def timer(self, stage, nbytes=0, items=1):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t, nbytes, items)
+
+    def report(self):
+        with self._lock:
+            stages = {}
+            for stage, h in self._hist.items():
+                stages[stage] = dict(items=self._items[stage], bytes=self._bytes[stage],
+                                     seconds=round(h.sum, 6), calls=h.count,
+                                     mb_per_s=round(self._bytes[stage] / 2 ** 20 / h.sum, 2) if h.sum else None,
+                                     buckets={str(le): c for le, c in h.cumulative()})
+            return dict(started=self.started, elapsed=round(time.time() - self.started, 3),
+                        stages=stages, counters=dict(self._counters))
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def to_prometheus(self, prefix='mat_ingest'):
+        lines = []
+        with self._lock:
+            lines.append('# HELP %s_seconds Latency of ingest stages.' % prefix)
+            lines.append('# TYPE %s_seconds histogram' % prefix)
+            for stage, h in sorted(self._hist.items()):
+                for le, c in h.cumulative():
+                    lines.append('%s_seconds_bucket{stage="%s",le="%s"} %d' % (prefix, stage, le, c))
+                lines.append('%s_seconds_sum{stage="%s"} %f' % (prefix, stage, h.sum))
+                lines.append('%s_seconds_count{stage="%s"} %d' % (prefix, stage, h.count))
+            for name, values, help_ in (('items', self._items, 'Items processed by ingest stages.'),
+                                        ('bytes', self._bytes, 'Bytes processed by ingest stages.')):
+                lines.append('# HELP %s_%s_total %s' % (prefix, name, help_))
+                lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+                for stage, v in sorted(values.items()):
+                    lines.append('%s_%s_total{stage="%s"} %d' % (prefix, name, stage, v))
+            for name, v in sorted(self._counters.items()):
+                lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+                lines.append('%s_%s_total %d' % (prefix, name, v))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """write a .prom file in Prometheus text format, anything else as json"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+metrics = Metrics()
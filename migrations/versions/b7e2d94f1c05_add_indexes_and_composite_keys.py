@@ -0,0 +1,64 @@
+"""add indexes and composite keys
+
+Revision ID: b7e2d94f1c05
+Revises: 9a41d3c7e2b8
+Create Date: 2026-10-18 14:26:41.907153
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d94f1c05'
+down_revision = '9a41d3c7e2b8'
+branch_labels = None
+depends_on = None
+
+# 关联表: (表名, 主键列, 反向索引)
+LINK_TABLES = (
+    ('t_mat_tag', ['mat_id', 'tag_id'], 'ix_t_mat_tag_tag_id_mat_id'),
+    ('association', ['student_id', 'teacher_id'], 'ix_association_teacher_id_student_id'),
+)
+
+
+def _dedupe(table, cols):
+    """主键不允许重复/空行, 建主键前先去重"""
+    tmp = '_%s_dedupe' % table
+    names = ', '.join(cols)
+    not_null = ' AND '.join('%s IS NOT NULL' % c for c in cols)
+    op.execute('CREATE TABLE %s AS SELECT DISTINCT %s FROM %s WHERE %s' % (tmp, names, table, not_null))
+    op.execute('DELETE FROM %s' % table)
+    op.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (table, names, names, tmp))
+    op.execute('DROP TABLE %s' % tmp)
+
+
+def upgrade():
+    for table, cols, reverse_ix in LINK_TABLES:
+        _dedupe(table, cols)
+        with op.batch_alter_table(table) as batch_op:
+            for c in cols:
+                batch_op.alter_column(c, existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key('pk_%s' % table, cols)
+        op.create_index(reverse_ix, table, cols[::-1], unique=False)
+
+    op.create_index(op.f('ix_material_cat_id'), 'material', ['cat_id'], unique=False)
+    op.create_index(op.f('ix_material_root_id'), 'material', ['root_id'], unique=False)
+    op.create_index(op.f('ix_material_used_times'), 'material', ['used_times'], unique=False)
+    op.create_index('ix_material_cat_id_used_times', 'material', ['cat_id', 'used_times'], unique=False)
+    op.create_index(op.f('ix_note_timestamp'), 'note', ['timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_note_timestamp'), table_name='note')
+    op.drop_index('ix_material_cat_id_used_times', table_name='material')
+    op.drop_index(op.f('ix_material_used_times'), table_name='material')
+    op.drop_index(op.f('ix_material_root_id'), table_name='material')
+    op.drop_index(op.f('ix_material_cat_id'), table_name='material')
+
+    for table, cols, reverse_ix in LINK_TABLES[::-1]:
+        op.drop_index(reverse_ix, table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint('pk_%s' % table, type_='primary')
+            for c in cols:
+                batch_op.alter_column(c, existing_type=sa.Integer(), nullable=True)
@@ -1,7 +1,9 @@
 # coding:utf-8
 # author: jason.li
 
-from app import db
+import os
+from datetime import datetime
+from extensions import db
 
 
 ######################################## Materials
@@ -73,9 +75,11 @@ class MatCategory(db.Model, C):
 
 # many <-> many (Material <-> MatTag)
 # secondary table for m to m
+# 复合主键(mat_id, tag_id)用于按材质取标签, 反向索引(tag_id, mat_id)用于按标签取材质
 t_mat_tag = db.Table('t_mat_tag',
-                     db.Column('mat_id', db.Integer, db.ForeignKey('material.id')),
-                     db.Column('tag_id', db.Integer, db.ForeignKey('mat_tag.id'))
+                     db.Column('mat_id', db.Integer, db.ForeignKey('material.id'), primary_key=True),
+                     db.Column('tag_id', db.Integer, db.ForeignKey('mat_tag.id'), primary_key=True),
+                     db.Index('ix_t_mat_tag_tag_id_mat_id', 'tag_id', 'mat_id')
                      )
 
 
@@ -106,16 +110,30 @@ class MatMD5(db.Model, C):
         return '<MatMD5 {}>'.format(self.md5)
 
 
+class MatMeta(db.Model, C):
+    """parsed .sbsar metadata keyed by the material md5, data is zlib compressed json (see matmeta.py)"""
+    __tablename__ = 'mat_meta'
+
+    md5 = db.Column(db.String(128), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary(length=2 ** 24), nullable=False)
+
+    def __repr__(self):
+        return '<MatMeta {}>'.format(self.md5)
+
+
 def _material_next_id():
     return Material.query.count() + 1
 
 
 class Material(db.Model, C):
     __tablename__ = 'material'
+    # 分类内按热度排序(counters.popular)
+    __table_args__ = (db.Index('ix_material_cat_id_used_times', 'cat_id', 'used_times'),)
 
     id = db.Column(db.Integer, primary_key=1)
     # many -> one (Material -> MatCategory)
-    cat_id = db.Column(db.Integer, db.ForeignKey('mat_category.id'))
+    cat_id = db.Column(db.Integer, db.ForeignKey('mat_category.id'), index=True)
     category = db.relationship('MatCategory', back_populates='materials')
     # many <-> many
     tags = db.relationship('MatTag', secondary=t_mat_tag, back_populates='materials')
@@ -127,15 +145,19 @@ class Material(db.Model, C):
     relative_path = db.Column(db.String(512))
     has_sbszip = db.Column(db.Boolean, default=False)
     thumbnail = db.Column(db.String(512))
-    used_times = db.Column(db.Integer, default=0)
+    # 已生成的缩略图尺寸, 如 '128,256,512', thumbnail为最大尺寸
+    thumb_sizes = db.Column(db.String(64))
+    used_times = db.Column(db.Integer, default=0, index=True)
     # duplicate column
     md5 = db.Column(db.String(128), unique=True)
     # one <-> one
     md5_id = db.Column(db.Integer, db.ForeignKey('mat_md5.id'))
     md5_ = db.relationship('MatMD5', back_populates='material')
     # many -> one (Material <-> Root)
-    root_id = db.Column(db.Integer, db.ForeignKey('root.id'), default=3)
+    root_id = db.Column(db.Integer, db.ForeignKey('root.id'), default=3, index=True)
     root = db.relationship('Root', back_populates='materials')
+    # 最后修改时间, 用于HTTP缓存(Last-Modified)
+    timestamp = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
     def setCategory(self, cat):
         """init cat_id for put this into db, Associate with MatCategory"""
@@ -195,6 +217,15 @@ class Material(db.Model, C):
             print('new AssetMd5 {} and set {} md5_id={}'.format(obj, self, self.md5_id))
         # db.session.commit()
 
+    def thumbFor(self, size):
+        """thumbnail path of the smallest generated size >= size (or the largest one)"""
+        if not self.thumb_sizes:
+            return self.thumbnail
+        sizes = [int(x) for x in self.thumb_sizes.split(',')]
+        fit = min([x for x in sizes if x >= size] or [max(sizes)])
+        base, ext = os.path.splitext(self.thumbnail)
+        return '%s_%d%s' % (base.rsplit('_', 1)[0], fit, ext)
+
     def __repr__(self):
         return '<Material {}>'.format(self.name)
 
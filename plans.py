@@ -0,0 +1,85 @@
+# coding:utf-8
+# author: jason.li
+"""
+主要浏览/搜索查询的执行计划检查 (SQLite)::
+    在内存SQLite中按当前模型建表, 对每条查询执行 EXPLAIN QUERY PLAN;
+    出现未使用索引的全表扫描(SCAN <table>)或临时自动索引即视为失败,
+    防止以后改动表结构时悄悄丢掉索引
+
+    python -m pytest -q test_plans.py   (测试, 有失败即不通过)
+    flask checkplans            (逐条打印执行计划, 有失败时退出码为1)
+    from plans import check_plans
+"""
+import re
+
+from sqlalchemy import create_engine, select
+
+from app import db, Note, Student, Teacher, association_table
+from models import Material, MatCategory, MatTag, t_mat_tag
+from serialize import material_select
+
+# 未用索引的全表扫描: 'SCAN material' (带 'USING ... INDEX' 的按索引顺序扫描不算)
+_FULL_SCAN = re.compile(r'^SCAN (\S+)$')
+
+
+def _cat_id(name):
+    return select(MatCategory.id).where(MatCategory.name == name).scalar_subquery()
+
+
+def queries():
+    """[(name, statement)] of the queries the site and the ingest run most"""
+    return [
+        ('materials page', material_select(Material.id > 100, limit=50)),
+        ('materials by category', material_select(Material.id > 100, Material.cat_id == _cat_id('wood'), limit=50)),
+        ('materials by root', material_select(Material.id > 100, Material.root_id == 3, limit=50)),
+        ('material detail', material_select(Material.id == 7)),
+        ('materials of tag', select(Material.id, Material.name)
+            .join(t_mat_tag, t_mat_tag.c.mat_id == Material.id)
+            .join(MatTag, MatTag.id == t_mat_tag.c.tag_id)
+            .where(MatTag.name == 'wood')),
+        ('tags of materials', select(t_mat_tag.c.mat_id, MatTag.name)
+            .join(MatTag, MatTag.id == t_mat_tag.c.tag_id)
+            .where(t_mat_tag.c.mat_id.in_([1, 2, 3]))),
+        ('tag index refresh', select(t_mat_tag.c.mat_id, MatTag.name)
+            .join(MatTag, MatTag.id == t_mat_tag.c.tag_id)
+            .where(t_mat_tag.c.mat_id > 100)),
+        ('popular', select(Material.id).order_by(Material.used_times.desc()).limit(20)),
+        ('popular in category', select(Material.id).where(Material.cat_id == 2)
+            .order_by(Material.used_times.desc()).limit(20)),
+        ('latest notes', select(Note.id).order_by(Note.timestamp.desc()).limit(20)),
+        ('teachers of student', select(Teacher.name)
+            .join(association_table, association_table.c.teacher_id == Teacher.id)
+            .where(association_table.c.student_id == 1)),
+        ('students of teacher', select(Student.name)
+            .join(association_table, association_table.c.student_id == Student.id)
+            .where(association_table.c.teacher_id == 1)),
+    ]
+
+
+def explain(conn, stmt):
+    """EXPLAIN QUERY PLAN details of stmt"""
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    return [r[-1] for r in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def problems(details):
+    """plan lines that mean a full scan or an index sqlite had to build on the fly"""
+    return [d for d in details if _FULL_SCAN.match(d) or 'AUTOMATIC' in d]
+
+
+def check_plans(echo=print):
+    """explain every query on an empty in-memory sqlite, return {name: [bad plan lines]}"""
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    failed = {}
+    with engine.connect() as conn:
+        for name, stmt in queries():
+            details = explain(conn, stmt)
+            bad = problems(details)
+            if bad:
+                failed[name] = bad
+            echo('%s %s' % ('FAIL' if bad else 'ok  ', name))
+            for d in details:
+                echo('      ' + d)
+    engine.dispose()
+    return failed
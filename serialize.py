@@ -0,0 +1,101 @@
+# coding:utf-8
+# author: jason.li
+"""
+按列投影的批量序列化 (替代逐个实例调用 C.toDict)::
+    直接对表执行 Core select, 行元组 -> dict -> JSON bytes, 不构造ORM实例、不触发关系懒加载;
+    关联名称在同一条SQL里取出: category/root 用外连接, tags 用 group_concat 子查询
+    有 orjson 时用它编码, 否则退回标准库 json
+
+    from serialize import model_rows, material_rows, dumps
+    dumps(model_rows(Note))                        # app.py / models.py 中任意 db.Model
+    dumps(material_rows(Material.id > 100, limit=50))
+"""
+import json
+from datetime import date, datetime
+
+from sqlalchemy import select, func
+
+from extensions import db
+from models import Material, MatCategory, MatTag, Root, t_mat_tag
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# group_concat 的默认分隔符(sqlite/mysql一致), 标签名由 ';' 拆分而来, 不含逗号
+TAG_SEP = ','
+
+
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    raise TypeError('%r is not JSON serializable' % type(obj))
+
+
+def dumps(obj):
+    """obj -> JSON bytes (utf-8), datetimes as ISO 8601"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, default=_default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _table(model):
+    return getattr(model, '__table__', model)
+
+
+def model_select(model, *where, extra=(), order_by=None, limit=None, select_from=None, group_by=None):
+    """Core select of all table columns of model (or Table) plus the labeled expressions in extra"""
+    table = _table(model)
+    stmt = select(*table.columns, *extra).select_from(select_from if select_from is not None else table)
+    for w in where:
+        stmt = stmt.where(w)
+    if group_by is not None:
+        stmt = stmt.group_by(*group_by)
+    stmt = stmt.order_by(*(order_by if order_by is not None else table.primary_key.columns))
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def _dicts(stmt):
+    result = db.session.execute(stmt)
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result]
+
+
+def model_rows(model, *where, **kwargs):
+    """
+    rows of any model (or Table) as dicts with the same keys as C.toDict,
+    plus one key per labeled expression in extra (see model_select)
+    """
+    return _dicts(model_select(model, *where, **kwargs))
+
+
+def material_select(*where, order_by=None, limit=None):
+    """select used by material_rows (also checked by plans.py)"""
+    cat = MatCategory.__table__.alias('c')
+    root = Root.__table__.alias('r')
+    tag = MatTag.__table__.alias('t')
+    # 按 material.id 分组拼接标签名, 每个材质仍只占一行(limit按材质计)
+    joined = (Material.__table__
+              .outerjoin(cat, cat.c.id == Material.cat_id)
+              .outerjoin(root, root.c.id == Material.root_id)
+              .outerjoin(t_mat_tag, t_mat_tag.c.mat_id == Material.id)
+              .outerjoin(tag, tag.c.id == t_mat_tag.c.tag_id))
+    return model_select(Material, *where,
+                        extra=(cat.c.name.label('category'), root.c.name.label('root'),
+                               func.group_concat(tag.c.name).label('tags')),
+                        order_by=order_by, limit=limit, select_from=joined,
+                        group_by=(Material.id, cat.c.name, root.c.name))
+
+
+def material_rows(*where, order_by=None, limit=None):
+    """Material rows: toDict() keys + category/root names + sorted tag names"""
+    rows = _dicts(material_select(*where, order_by=order_by, limit=limit))
+    for r in rows:
+        r['tags'] = sorted(r['tags'].split(TAG_SEP)) if r['tags'] else []
+    return rows
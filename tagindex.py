@@ -0,0 +1,181 @@
+# coding:utf-8
+# author: jason.li
+"""
+标签倒排索引::
+    MatTag.name -> 材质id位图(python int, 第id位为1)
+    AND/OR/NOT 即位运算, 前缀补全使用排序后的标签名 + bisect
+
+    from tagindex import tag_index
+    tag_index.search(tags=['wood'], any_tags=['oak', 'pine'], not_tags=['painted'])
+    tag_index.complete('wo')
+
+索引在第一次使用时从数据库构建; put2db 写入后调用 remove()/add(), 其他进程新增的材质
+通过按 id 增量刷新获得, 修改(timestamp变化)或删除的材质使索引整体重建(最多 REFRESH_SECONDS 秒延迟)
+"""
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from sqlalchemy import func, case
+
+from extensions import db
+from models import Material, MatTag, t_mat_tag
+
+REFRESH_SECONDS = 5
+
+# 每个字节中为1的位
+_BYTE_BITS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+
+
+def bitmap_ids(bitmap):
+    """sorted ids of the bits set in bitmap"""
+    ret = []
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for i, b in enumerate(data):
+        if b:
+            base = i * 8
+            ret.extend(base + x for x in _BYTE_BITS[b])
+    return ret
+
+
+def _popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+class TagIndex(object):
+    """in-process inverted index from tag name to a bitmap of material ids"""
+
+    def __init__(self):
+        self._bits = {}
+        self._names = []
+        self._all = 0
+        self._max_id = 0
+        self._stamp = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def load(self):
+        """(re)build from the database"""
+        with self._lock:
+            self._bits = {}
+            self._all = 0
+            self._max_id = 0
+            self._stamp = db.session.query(func.max(Material.timestamp)).scalar()
+            self._load_after(0)
+            self._names = sorted(self._bits)
+            self.loaded = True
+            self._checked = time.time()
+
+    def _load_after(self, after):
+        """add materials with id > after, caller holds the lock"""
+        ids = [r[0] for r in db.session.query(Material.id).filter(Material.id > after)]
+        rows = db.session.query(t_mat_tag.c.mat_id, MatTag.name) \
+            .join(MatTag, MatTag.id == t_mat_tag.c.tag_id) \
+            .filter(t_mat_tag.c.mat_id > after)
+        self._add_rows(ids, rows)
+        return len(ids)
+
+    def _add_rows(self, ids, rows):
+        bits = dict(self._bits)
+        for mat_id, name in rows:
+            bits[name] = bits.get(name, 0) | 1 << mat_id
+        all_ = self._all
+        for i in ids:
+            all_ |= 1 << i
+            self._max_id = max(self._max_id, i)
+        # 替换而不是原地修改, 查询线程不需要加锁
+        self._bits = bits
+        self._all = all_
+
+    def add(self, mats):
+        """add new materials (objects with .id and .tags, e.g. MatRecord from put2db)"""
+        if not self.loaded:
+            return
+        with self._lock:
+            self._add_rows([m.id for m in mats], [(m.id, t.lower()) for m in mats for t in m.tags])
+            self._names = sorted(self._bits)
+
+    def remove(self, ids):
+        """drop materials (deleted, or modified ones before add() with their new tags)"""
+        if not self.loaded or not ids:
+            return
+        mask = 0
+        for i in ids:
+            mask |= 1 << i
+        with self._lock:
+            keep = ~mask
+            self._bits = {n: b & keep for n, b in self._bits.items() if b & keep}
+            self._all &= keep
+            self._names = sorted(self._bits)
+
+    def refresh(self, force=False):
+        """load on first use, then pick up materials added, modified or deleted by other processes"""
+        if not self.loaded:
+            self.load()
+            return
+        now = time.time()
+        if not force and now - self._checked < REFRESH_SECONDS:
+            return
+        self._checked = now
+        # 已索引的材质中 timestamp 晚于上次检查的即被修改过
+        modified = Material.timestamp > self._stamp if self._stamp is not None else Material.timestamp.isnot(None)
+        max_id, count, stamp, changed = db.session.query(
+            func.max(Material.id), func.count(Material.id), func.max(Material.timestamp),
+            func.sum(case(((Material.id <= self._max_id) & modified, 1), else_=0))).one()
+        if changed:
+            self.load()
+            return
+        with self._lock:
+            if (max_id or 0) > self._max_id:
+                self._load_after(self._max_id)
+                self._names = sorted(self._bits)
+            self._stamp = stamp
+        if count != _popcount(self._all):
+            # 有材质被删除
+            self.load()
+
+    def search(self, tags=(), any_tags=(), not_tags=()):
+        """material ids having all tags, at least one of any_tags and none of not_tags,
+        ranked by the number of any_tags matched (then by id)
+        """
+        self.refresh()
+        bits = self._bits
+        result = self._all
+        for t in tags:
+            result &= bits.get(t.lower(), 0)
+        if any_tags:
+            any_bits = [bits.get(t.lower(), 0) for t in any_tags]
+            union = 0
+            for b in any_bits:
+                union |= b
+            result &= union
+        for t in not_tags:
+            result &= ~bits.get(t.lower(), 0)
+        if not any_tags or len(any_tags) == 1:
+            return bitmap_ids(result)
+        score = Counter()
+        for b in any_bits:
+            score.update(bitmap_ids(result & b))
+        return sorted(score, key=lambda i: (-score[i], i))
+
+    def count(self, tag):
+        self.refresh()
+        return _popcount(self._bits.get(tag.lower(), 0))
+
+    def complete(self, prefix, limit=10):
+        """[(tag, material count)] of tags starting with prefix, most used first"""
+        self.refresh()
+        prefix = prefix.lower()
+        names = self._names
+        found = []
+        i = bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            found.append((names[i], _popcount(self._bits[names[i]])))
+            i += 1
+        found.sort(key=lambda x: (-x[1], x[0]))
+        return found[:limit]
+
+
+tag_index = TagIndex()
@@ -0,0 +1,179 @@
+# coding:utf-8
+"""
+增量入库 (put2db incremental=True) 对修改、删除、移动/改名目录的处理, 以及监视模式下的移动:
+
+    python -m pytest -q test_ingest.py
+"""
+import os
+import shutil
+
+import py7zr
+import pytest
+from flask import current_app
+
+from app import create_app, db
+from models import Material, MatMD5, t_mat_tag
+import tools
+import watch
+
+
+def make_mat(root, cat, name, keywords):
+    """write root/cat/name/name.sbsar whose graph has keywords (its tags)"""
+    fd = os.path.join(root, cat, name)
+    os.makedirs(fd, exist_ok=True)
+    xml = ('<sbsdescription><graphs><graph pkgurl="pkg://%s" keywords="%s"><outputs>'
+           '<output identifier="basecolor"/></outputs></graph></graphs></sbsdescription>' % (name, ';'.join(keywords)))
+    sbsar = os.path.join(fd, name + '.sbsar')
+    if os.path.exists(sbsar):
+        os.remove(sbsar)
+    with py7zr.SevenZipFile(sbsar, 'w') as z:
+        z.writestr(xml, name + '.xml')
+    return fd
+
+
+@pytest.fixture
+def lib(tmp_path, monkeypatch):
+    source = str(tmp_path / 'source')
+    for cat in ('wood', 'metal'):
+        for i in range(2):
+            make_mat(source, cat, '%s_%d' % (cat, i), [cat, 'n%d' % i])
+    monkeypatch.setattr(tools, 'manifest_file', str(tmp_path / 'manifest.json'))
+    monkeypatch.setattr(tools, 'md5_cache_file', str(tmp_path / 'md5cache.json'))
+    monkeypatch.setattr(tools, 'thumb_root', str(tmp_path / 'thumbs'))
+    monkeypatch.setattr(tools, 'mat_source', source)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'mat.db'),
+                      'MAT_SOURCE': source, 'MAT_JOBS_DB': str(tmp_path / 'jobs.db')})
+    with app.app_context():
+        db.create_all()
+        tools.put2db(incremental=True, source=source)
+        yield source
+        db.session.remove()
+
+
+def rows():
+    """{relative_path: (id, md5, category, sorted tags, used_times)}"""
+    return {m.relative_path: (m.id, m.md5, m.category.name, sorted(t.name for t in m.tags), m.used_times)
+            for m in Material.query}
+
+
+def check_consistent():
+    mats = Material.query.all()
+    assert len({m.relative_path for m in mats}) == len(mats)
+    assert MatMD5.query.count() == len(mats)
+    ids = {m.id for m in mats}
+    assert {r[0] for r in db.session.execute(t_mat_tag.select())} <= ids
+
+
+def test_unchanged(lib):
+    before = rows()
+    assert tools.put2db(incremental=True, source=lib) == 0
+    assert rows() == before
+
+
+def test_modified_folder_updates_row(lib):
+    Material.query.filter_by(name='wood_0').update({'used_times': 5})
+    db.session.commit()
+    before = rows()['wood\\wood_0']
+    make_mat(lib, 'wood', 'wood_0', ['wood', 'changed'])
+    assert tools.put2db(incremental=True, source=lib) == 1
+    after = rows()
+    assert len(after) == 4
+    mat_id, md5, cat, tags, used = after['wood\\wood_0']
+    assert (mat_id, used) == (before[0], 5)
+    assert md5 != before[1]
+    assert tags == ['changed', 'wood']
+    check_consistent()
+
+
+def test_deleted_folder_removes_row(lib):
+    shutil.rmtree(os.path.join(lib, 'metal', 'metal_1'))
+    tools.put2db(incremental=True, source=lib)
+    assert sorted(rows()) == ['metal\\metal_0', 'wood\\wood_0', 'wood\\wood_1']
+    check_consistent()
+
+
+def test_moved_folder_keeps_row(lib):
+    before = rows()['wood\\wood_1']
+    shutil.move(os.path.join(lib, 'wood', 'wood_1'), os.path.join(lib, 'metal', 'wood_1'))
+    tools.put2db(incremental=True, source=lib)
+    after = rows()
+    assert len(after) == 4 and 'wood\\wood_1' not in after
+    assert after['metal\\wood_1'][:2] == before[:2]
+    assert after['metal\\wood_1'][2] == 'metal'
+    check_consistent()
+    # 之后的增量入库不再改变
+    assert tools.put2db(incremental=True, source=lib) == 0
+    assert rows() == after
+
+
+def test_watch_moved_folder_keeps_row(lib):
+    before = rows()['metal\\metal_0']
+    w = watch.FolderWatcher(lib, events=False, stable=1)
+    now = 1000.0
+
+    def tick():
+        folders = w.ready(now)
+        gone = w.gone(folders)
+        if folders or gone:
+            w.ingest(folders, now, gone=gone)
+
+    tick()
+    os.rename(os.path.join(lib, 'metal', 'metal_0'), os.path.join(lib, 'metal', 'metal_zero'))
+    os.rename(os.path.join(lib, 'metal', 'metal_zero', 'metal_0.sbsar'),
+              os.path.join(lib, 'metal', 'metal_zero', 'metal_zero.sbsar'))
+    # 第一次看到新目录时开始计时, 稳定后与消失的目录一起入库
+    tick()
+    assert 'metal\\metal_0' in rows()
+    now += 2
+    tick()
+    after = rows()
+    assert len(after) == 4 and 'metal\\metal_0' not in after
+    assert after['metal\\metal_zero'][:2] == before[:2]
+    check_consistent()
+
+
+def test_counter_flush_keeps_timestamp(lib, tmp_path, monkeypatch):
+    from counters import UsageCounter
+    from tagindex import TagIndex
+    idx = TagIndex()
+    idx.load()
+    loads = []
+    monkeypatch.setattr(idx, 'load', lambda: loads.append(1))
+    mat = Material.query.filter_by(name='wood_0').one()
+    stamp = mat.timestamp
+    counter = UsageCounter(spill=str(tmp_path / 'spill.json'))
+    counter.incr(mat.id, 3)
+    assert counter.flush() == 1
+    db.session.expire_all()
+    mat = db.session.get(Material, mat.id)
+    assert (mat.used_times, mat.timestamp) == (3, stamp)
+    # 计数不算修改, 索引无需整体重建
+    idx.refresh(force=True)
+    assert loads == []
+
+
+@pytest.mark.parametrize('body', [{'workers': -1}, {'chunk': 0}, {'use_cache': 'nope'},
+                                  {'incremental': 1}, {'chunk': 2.5}, {'workers': True}])
+def test_start_ingest_rejects_invalid_params(lib, body):
+    resp = current_app.test_client().post('/api/jobs/ingest', json=body)
+    assert resp.status_code == 400, resp.get_json()
+    resp.close()
+
+
+def test_ingest_params_clamps_workers():
+    from jobs import ingest_params
+    assert ingest_params({'workers': 10 ** 6, 'use_cache': 'false'}) == {'workers': os.cpu_count() or 1, 'use_cache': False}
+    assert ingest_params({'workers': 0})['workers'] is None
+
+
+def test_other_source_keeps_own_manifest(lib, tmp_path):
+    other = str(tmp_path / 'other')
+    make_mat(other, 'stone', 'stone_0', ['stone'])
+    tools.put2db(incremental=True, source=other)
+    assert os.path.exists(tools.source_file(tools.manifest_file, other))
+    # 另一个source的清单不影响mat_source, 反之亦然
+    assert len(rows()) == 5
+    assert tools.put2db(incremental=True, source=lib) == 0
+    assert tools.put2db(incremental=True, source=other) == 0
+    assert len(rows()) == 5
+    check_consistent()
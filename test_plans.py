@@ -0,0 +1,11 @@
+# coding:utf-8
+"""
+主要查询不得出现全表扫描或临时自动索引 (见plans.py), 改动表结构或查询后运行:
+
+    python -m pytest -q test_plans.py
+"""
+from plans import check_plans
+
+
+def test_no_full_scans():
+    assert check_plans(echo=lambda s: None) == {}
@@ -4,12 +4,64 @@ import os
 import hashlib
 import zipfile
 import py7zr
-import tempfile
+import json
+import time
+import errno
+import shutil
 import xml.etree.ElementTree as ET
+from itertools import groupby
+from sqlalchemy import bindparam
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from models import *
+from tagindex import tag_index
+from metrics import metrics
+from cache import lookup_cache
+from matmeta import META_VERSION, pack, load_meta, save_meta, meta_tags
+from flask import has_app_context
 
+try:
+    # 可选依赖, 用于生成缩略图 (pip install pillow)
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 安静模式: 不输出每个文件的处理信息 (大量输出本身会拖慢入库), 见set_quiet
+QUIET = bool(os.getenv('MAT_QUIET'))
 # mat_source = 'E:\\mat'
-mat_source = 'E:\\SubstanceSourceMaterial'
+mat_source = os.getenv('MAT_SOURCE', 'E:\\SubstanceSourceMaterial')
+# md5缓存文件, key: (path, size, mtime_ns)
+md5_cache_file = os.getenv('MAT_MD5_CACHE', 'md5cache.json')
+MD5_CHUNK = 1024 * 1024
+# 增量入库清单文件, 记录已入库材质目录的文件状态
+manifest_file = os.getenv('MAT_MANIFEST', 'manifest.json')
+# 批量写入数据库时每个事务的材质数量
+DB_BATCH = 1000
+# 等待工作进程结果时调用tick(进度/取消检查)的间隔(秒), 见iter_mats
+TICK_SECONDS = 0.5
+# sbs打包zip的压缩算法与级别, 可选: store, deflate, bzip2, lzma
+ZIP_CODECS = {
+    'store': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+zip_codec = os.getenv('MAT_ZIP_CODEC', 'lzma')
+# deflate: 0-9, bzip2: 1-9, store与lzma忽略level
+zip_level = int(os.environ['MAT_ZIP_LEVEL']) if os.getenv('MAT_ZIP_LEVEL') else None
+# 缩略图: 输出目录(按category分目录, 以md5命名), 尺寸与格式(jpg或webp)
+thumb_root = os.getenv('MAT_THUMB_ROOT', 'thumbs')
+THUMB_SIZES = (128, 256, 512)
+thumb_format = os.getenv('MAT_THUMB_FORMAT', 'jpg')
+# .sbsar中xml描述文件读入内存的上限
+SBSAR_XML_LIMIT = 32 * 1024 * 1024
+# 重复检测: 参与比较的文件类型, 部分哈希读取首尾各DUP_BLOCK字节, 报告输出文件
+DUP_EXTS = ('.sbsar', '.sbs', '.png')
+DUP_BLOCK = 64 * 1024
+dup_report_file = os.getenv('MAT_DUP_REPORT', 'duplicates.json')
+# 发布目标目录(美术资源库), 按relative_path存放, 与网站下载目录(MAT_LIBRARY)一致
+publish_root = os.getenv('MAT_PUBLISH_ROOT', os.getenv('MAT_LIBRARY', 'library'))
+PUBLISH_WORKERS = 4
+COPY_CHUNK = 8 * 1024 * 1024
 
 """
 Material入库设计::
@@ -29,10 +81,26 @@ Material入库设计::
     
     4.写入数据库
     
-    5.可选copy资源到公司美术资源库目录 (或者部署网站的时候再手动处理)
+    5.可选copy资源到公司美术资源库目录 (见publish, 或者部署网站的时候再手动处理)
 """
 
 
+def set_quiet(quiet=True):
+    """turn per-file messages off (also in worker processes started afterwards)"""
+    global QUIET
+    QUIET = quiet
+    if quiet:
+        os.environ['MAT_QUIET'] = '1'
+    else:
+        os.environ.pop('MAT_QUIET', None)
+
+
+def log(*args):
+    """per-file progress message, dropped in quiet mode"""
+    if not QUIET:
+        print(*args)
+
+
 def normalize_folder_name(root_folder, only_remove_chars=[]):
     """默认移除路径中所有特殊字符(not isalnum),
     如果only_remove_chars不为空[],则仅移除指定的字符
@@ -67,17 +135,109 @@ def getMats(cat):
     return getSubFolderNames(root)
 
 
-def zip_file(file):
-    """zip *.sbs to *.zip"""
+def zip_file(file, codec=None, level=None):
+    """zip *.sbs to *.zip (codec: see ZIP_CODECS),
+    an existing zip newer than file is kept, a new zip is written to a temp file then renamed
+    """
     head, tail = os.path.split(file)
     root, ext = os.path.splitext(file)
     out_zip = '%s.zip' % root
-    # ZIP_LZMA 压缩率高一点比 ZIP_DEFLATED
-    with zipfile.ZipFile(out_zip, 'w', zipfile.ZIP_LZMA) as myzip:
-        myzip.write(file, arcname=tail)
+    try:
+        if os.stat(out_zip).st_mtime_ns >= os.stat(file).st_mtime_ns:
+            return out_zip
+    except OSError:
+        pass
+    codec = codec or zip_codec
+    level = zip_level if level is None else level
+    # ZIP_LZMA 压缩率高一点比 ZIP_DEFLATED, 但速度最慢
+    tmp = '%s.%d.tmp' % (out_zip, os.getpid())
+    try:
+        with zipfile.ZipFile(tmp, 'w', ZIP_CODECS[codec], compresslevel=level) as myzip:
+            myzip.write(file, arcname=tail)
+        os.replace(tmp, out_zip)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
     return out_zip
 
 
+def _zip_job(job):
+    file, codec, level = job
+    t = time.perf_counter()
+    try:
+        out_zip = zip_file(file, codec, level)
+        out_size = os.path.getsize(out_zip)
+    except Exception as ex:
+        print(f'[ZIP] {file}: {ex}')
+        out_zip, out_size = None, 0
+    return out_zip, os.path.getsize(file), out_size, time.perf_counter() - t
+
+
+def zip_files(files, codec=None, level=None, workers=1, tick=None):
+    """zip many *.sbs concurrently, return ([zip or None for each file], report)
+    report: files, MB in/out, ratio, cpu seconds, wall seconds and MB/s (wall) for the codec
+    tick: optional callable() after each zip (see iter_mats)
+    """
+    codec = codec or zip_codec
+    if codec not in ZIP_CODECS:
+        raise ValueError('unknown zip codec {}, use one of {}'.format(codec, ', '.join(ZIP_CODECS)))
+    t = time.perf_counter()
+    results = []
+    for r in _pool_map(_zip_job, [(f, codec, level) for f in files], workers, tick=tick):
+        metrics.observe('zip', r[3], r[1])
+        results.append(r)
+        if tick is not None:
+            tick()
+    wall = time.perf_counter() - t
+    mb_in = sum(r[1] for r in results) / 2 ** 20
+    mb_out = sum(r[2] for r in results) / 2 ** 20
+    report = dict(codec=codec, level=level, files=len(files), mb_in=round(mb_in, 2), mb_out=round(mb_out, 2),
+                  ratio=round(mb_out / mb_in, 3) if mb_in else None,
+                  cpu_seconds=round(sum(r[3] for r in results), 3), wall_seconds=round(wall, 3),
+                  mb_per_s=round(mb_in / wall, 2) if wall else None)
+    return [r[0] for r in results], report
+
+
+def read_sbsar_xml(sbsar, limit=SBSAR_XML_LIMIT):
+    """read the first .xml member of a .sbsar (7z) into memory, at most limit bytes,
+    return a file object or None
+    """
+    with py7zr.SevenZipFile(sbsar, 'r') as z:
+        ts = [f for f in z.getnames() if f.endswith('.xml')]
+        log(ts)
+        if not ts:
+            print(f'[ERR]cannot get an .xml file')
+            return None
+        t = ts[0]
+        if hasattr(z, 'read'):
+            # py7zr < 1.0
+            return z.read([t])[t]
+        factory = py7zr.io.BytesIOFactory(limit)
+        z.extract(targets=[t], factory=factory)
+    xml = factory.get(t)
+    xml.seek(0)
+    return xml
+
+
+def get_sbs_tags(sbs, name):
+    """stream the .sbs and return the tags of graph/attributes/tags
+    of the first graph whose identifier is name (stops parsing there)
+    """
+    for event, elem in ET.iterparse(sbs):
+        if elem.tag != 'graph':
+            continue
+        identifier = elem.find('identifier')
+        if identifier is not None:
+            _id = identifier.get('v')
+            if _id and _id.lower() == name:
+                tags = elem.find('attributes/tags')
+                if tags is not None and tags.get('v'):
+                    return tags.get('v').split(';')
+        # 已检查的graph立即释放, 内存占用不随文件大小增长
+        elem.clear()
+    return []
+
+
 def get_mat_tags(sbs_or_sbsar_file):
     """get sbs or sbsar tags from *.sbs or *.sbsar file"""
     ret = []
@@ -86,159 +246,1155 @@ def get_mat_tags(sbs_or_sbsar_file):
     ext = ext.lower()
 
     if ext == '.sbs':
-        print('get sbs tags')
-        tree = ET.parse(sbs_or_sbsar_file)
-        root = tree.getroot()
-        found = False
-        for graph in root.iter('graph'):
-            if found:
-                break
-            identifier = graph.find('identifier')
-            if identifier is not None:
-                _id = identifier.get('v')
-                if _id and _id.lower() == name:
-                    attributes = graph.find('attributes')
-                    if attributes is not None:
-                        tags = attributes.find('tags')
-                        if tags is not None:
-                            v = tags.get('v')
-                            if v:
-                                ret = v.split(';')
-                                found = True
-                    # for a in attributes.iter('tags'):
-                    #     v = a.get('v')
-                    #     if v:
-                    #         ret = v.split(';')
-                    #         found = True
-                    #         break
+        log('get sbs tags')
+        ret = get_sbs_tags(sbs_or_sbsar_file, name)
 
     elif ext == '.sbsar':
-        print('get sbsar tags')
-        tempDir = tempfile.gettempdir()
-        target = ''
-        with py7zr.SevenZipFile(sbs_or_sbsar_file, 'r') as z:
-            ts = [f for f in z.getnames() if f.endswith('.xml')]
-            print(ts)
-            if not ts:
-                print(f'[ERR]cannot get an .xml file')
-                return []
-            t = ts[0]
-            z.extract(tempDir, t)
-            target = os.path.join(tempDir, t)
-        if os.path.exists(target):
-            tree = ET.parse(target)
-            root = tree.getroot()
-            for graph in root.iter('graph'):
-                pkgurl = graph.attrib.get('pkgurl')
-                # pkgurl = "pkg://ceramic_foam_geometric"
-                if pkgurl.endswith(name):
-                    kws = graph.attrib.get('keywords')
+        log('get sbsar tags')
+        xml = read_sbsar_xml(sbs_or_sbsar_file)
+        if xml is None:
+            return []
+        try:
+            # 找到pkgurl对应的graph即停止解析
+            for event, elem in ET.iterparse(xml, events=('start', 'end')):
+                if event == 'end':
+                    elem.clear()
+                elif elem.tag == 'graph' and (elem.get('pkgurl') or '').endswith(name):
+                    # pkgurl = "pkg://ceramic_foam_geometric"
+                    kws = elem.get('keywords')
                     if kws:
                         ret = kws.split(';')
+                    break
+        except ET.ParseError as ex:
+            print(f'[ERR] {sbs_or_sbsar_file}: {ex}')
 
     ret = [v.lower() for v in ret if v]
-    return list(set(ret))
+    return sorted(set(ret))
+
+
+def _gui_label(elem, gui):
+    g = elem.find(gui)
+    return g.get('label') if g is not None else None
+
+
+def read_sbsar_meta(sbsar):
+    """parse the whole xml of a .sbsar once: graphs with their keywords, inputs and outputs
+    (see matmeta.py), return None when the archive cannot be read
+    """
+    try:
+        xml = read_sbsar_xml(sbsar)
+        if xml is None:
+            return None
+        graphs = []
+        for event, elem in ET.iterparse(xml):
+            if elem.tag != 'graph':
+                continue
+            kws = elem.get('keywords')
+            graphs.append(dict(
+                pkgurl=elem.get('pkgurl'), label=elem.get('label'), category=elem.get('category'),
+                keywords=kws.split(';') if kws else [],
+                inputs=[dict(identifier=i.get('identifier'), type=i.get('type'), label=_gui_label(i, 'inputgui'))
+                        for i in elem.iterfind('inputs/input')],
+                outputs=[dict(identifier=o.get('identifier'), label=_gui_label(o, 'outputgui'),
+                              usages=[u.get('name') for u in o.iter('usage') if u.get('name')])
+                         for o in elem.iterfind('outputs/output')]))
+            elem.clear()
+        return dict(v=META_VERSION, graphs=graphs)
+    except Exception as ex:
+        print(f'[META] {sbsar}: {ex}')
+    return None
 
 
 def get_md5(file):
     """if invalid return None"""
     try:
-        return hashlib.md5(open(file, 'rb').read()).hexdigest()
+        h = hashlib.md5()
+        buf = bytearray(MD5_CHUNK)
+        view = memoryview(buf)
+        with open(file, 'rb', buffering=0) as f:
+            # 分块读取, 内存占用固定为MD5_CHUNK
+            for n in iter(lambda: f.readinto(buf), 0):
+                h.update(view[:n])
+        return h.hexdigest()
     except Exception as ex:
         print(f'[GET_MD5] {ex}')
     return None
 
 
-def check_get_mats():
-    cats = getCategory()
-    # print(f'MatCategory:{cats}')
+def source_file(path, source=None):
+    """per-source state file (manifest, md5 cache): path itself for mat_source,
+    path with a hash of the absolute source before the extension for other sources
+    """
+    # 清单记录的是相对路径, 不同source共用会把另一个source的材质当作已删除
+    key = os.path.normcase(os.path.abspath(source or mat_source))
+    if key == os.path.normcase(os.path.abspath(mat_source)):
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, hashlib.md5(key.encode('utf-8')).hexdigest()[:12], ext)
+
+
+class HashCache(object):
+    """on-disk md5 cache, an entry is valid while the file's size and mtime_ns are unchanged"""
+
+    def __init__(self, path=md5_cache_file):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as ex:
+                print(f'[HASH_CACHE] ignore broken cache {path}: {ex}')
+
+    def get(self, file, size, mtime_ns):
+        """return cached md5 or None (stale entries are dropped)"""
+        e = self._data.get(file)
+        if e and e[0] == size and e[1] == mtime_ns:
+            self.hits += 1
+            return e[2]
+        if e:
+            self.invalidate(file)
+        self.misses += 1
+        return None
+
+    def put(self, file, size, mtime_ns, md5):
+        if md5:
+            self._data[file] = [size, mtime_ns, md5]
+            self._dirty = True
+
+    def invalidate(self, file=None):
+        """drop one entry, or all entries when file is None"""
+        if file is None:
+            self._data.clear()
+        else:
+            self._data.pop(file, None)
+        self._dirty = True
+
+    def prune(self):
+        """drop entries of files that no longer exist"""
+        for file in [f for f in self._data if not os.path.exists(f)]:
+            self.invalidate(file)
+
+    def stats(self):
+        return dict(entries=len(self._data), hits=self.hits, misses=self.misses)
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def _edge_md5(job):
+    """md5 of the first and last DUP_BLOCK bytes (the whole file when it is small),
+    return (path, hash, is full md5, bytes read)
+    """
+    path, size = job
+    if size <= 2 * DUP_BLOCK:
+        return path, get_md5(path), True, size
+    try:
+        h = hashlib.md5()
+        with open(path, 'rb', buffering=0) as f:
+            h.update(f.read(DUP_BLOCK))
+            f.seek(-DUP_BLOCK, os.SEEK_END)
+            h.update(f.read(DUP_BLOCK))
+        return path, h.hexdigest(), False, 2 * DUP_BLOCK
+    except OSError as ex:
+        print(f'[DUP] {path}: {ex}')
+        return path, None, False, 0
+
+
+def _full_md5(path):
+    return path, get_md5(path)
+
+
+def _collisions(groups):
+    """only the groups that still have more than one file"""
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def find_duplicates(files, workers=1, cache=None):
+    """files: [(path, size, mtime_ns)], return the duplicate report (see dup_report_file)
+    1.按(扩展名, 大小)分桶, 大小唯一的文件不需要读取
+    2.同一桶内比较首尾块的哈希 (小文件直接计算完整md5)
+    3.仍然冲突的文件才计算完整md5, cache: 可选HashCache, 已缓存的md5不再读取
+    """
+    t0 = time.perf_counter()
+    info = {path: (size, mtime_ns) for path, size, mtime_ns in files}
+    buckets = {}
+    for path, size, _ in files:
+        buckets.setdefault((os.path.splitext(path)[1].lower(), size), []).append(path)
+    same_size = [g for k, g in buckets.items() if len(g) > 1 and k[1] > 0]
+    tiers = dict(size=dict(files=len(files), candidates=sum(len(g) for g in same_size)))
+
+    # tier 2
+    t = time.perf_counter()
+    edges = {}
+    md5s = {}
+    nread = 0
+    jobs = [(p, info[p][0]) for g in same_size for p in g]
+    for path, h, full, n in _pool_map(_edge_md5, jobs, workers, chunksize=16):
+        nread += n
+        if h is None:
+            continue
+        if full:
+            md5s[path] = h
+        edges.setdefault((os.path.splitext(path)[1].lower(), info[path][0], h), []).append(path)
+    metrics.observe('dedup', time.perf_counter() - t, nread, len(jobs))
+    collide = [p for g in _collisions(edges) for p in g if p not in md5s]
+    tiers['partial'] = dict(files=len(jobs), bytes_read=nread, candidates=len(collide))
+
+    # tier 3
+    t = time.perf_counter()
+    full_read = 0
+    cached = 0
+    todo = []
+    for path in collide:
+        md5 = cache.get(path, *info[path]) if cache is not None else None
+        if md5:
+            md5s[path] = md5
+            cached += 1
+        else:
+            todo.append(path)
+    for path, md5 in _pool_map(_full_md5, todo, workers, chunksize=4):
+        full_read += info[path][0]
+        if md5:
+            md5s[path] = md5
+            if cache is not None:
+                cache.put(path, info[path][0], info[path][1], md5)
+    metrics.observe('dedup', time.perf_counter() - t, full_read, len(todo))
+    tiers['full'] = dict(files=len(todo), cached=cached, bytes_read=full_read)
+
+    same = {}
+    for path, md5 in md5s.items():
+        same.setdefault((os.path.splitext(path)[1].lower(), md5), []).append(path)
+    groups = []
+    for (ext, md5), paths in sorted(same.items()):
+        if len(paths) > 1:
+            paths.sort()
+            groups.append(dict(ext=ext, md5=md5, size=info[paths[0]][0], keep=paths[0], duplicates=paths[1:]))
+    total = sum(x[0] for x in info.values())
+    return dict(files=len(files), bytes_total=total, bytes_read=nread + full_read,
+                seconds=round(time.perf_counter() - t0, 4), tiers=tiers,
+                wasted_bytes=sum(g['size'] * len(g['duplicates']) for g in groups), groups=groups)
+
+
+def find_source_duplicates(source=None, workers=1, cache=None, out=None):
+    """find duplicate .sbsar/.sbs/.png in source (mat_source by default),
+    write the report to out (dup_report_file by default) and return it
+    """
+    files = [f for folder in iter_mat_source(source) for ext, f in folder.files.items() if ext in DUP_EXTS]
+    report = find_duplicates(files, workers, cache)
+    out = out or dup_report_file
+    tmp = '%s.tmp' % out
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp, out)
+    print('duplicates: {} groups, {} wasted bytes, read {} of {} bytes'.format(
+        len(report['groups']), report['wasted_bytes'], report['bytes_read'], report['bytes_total']))
+    return report
+
+
+def load_duplicates(path=None):
+    """paths of duplicate .sbsar files in a find_source_duplicates report (kept copies excluded)"""
+    with open(path or dup_report_file, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    return {p for g in report['groups'] if g['ext'] == '.sbsar' for p in g['duplicates']}
+
+
+class Manifest(object):
+    """material folders already ingested, with (ext, size, mtime_ns) of their source files,
+    check_get_mats only processes folders whose files changed since the last commit()
+    """
+    # .zip由.sbs生成, 不参与比较
+    EXTS = ('.sbsar', '.sbs', '.png')
+
+    def __init__(self, path=manifest_file):
+        self.path = path
+        self._data = {}
+        self._pending = {}
+        self._seen = set()
+        self.delta = dict(added=[], modified=[], deleted=[], unchanged=0)
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError) as ex:
+                print(f'[MANIFEST] ignore broken manifest {path}: {ex}')
+
+    @classmethod
+    def signature(cls, folder):
+        """signature of a MatFolder, from the stats cached by scan_mat_source"""
+        return [[ext, folder.files[ext][1], folder.files[ext][2]] for ext in cls.EXTS if ext in folder.files]
+
+    def known(self, key):
+        """signature committed for key, or None"""
+        return self._data.get(key)
+
+    def changed(self, key, sig):
+        """return 'added', 'modified' or None (unchanged) and record key as seen"""
+        self._seen.add(key)
+        old = self._data.get(key)
+        if old is None:
+            return 'added'
+        if old != sig:
+            return 'modified'
+        self.delta['unchanged'] += 1
+        return None
+
+    def stage(self, key, sig, state):
+        """remember sig of a folder going into db, applied by commit()"""
+        self._pending[key] = sig
+        self.delta[state].append(key)
+
+    def keys(self):
+        """keys of the committed folders"""
+        return set(self._data)
+
+    def finish_scan(self, partial=False, gone=()):
+        """partial: only some folders were checked (see iter_mats folders), only the known keys
+        in gone (folders the caller saw disappear) count as deleted
+        """
+        if partial:
+            self.delta['deleted'] = sorted(k for k in gone if k in self._data and k not in self._seen)
+        else:
+            self.delta['deleted'] = sorted(k for k in self._data if k not in self._seen)
+        return self.delta
+
+    def commit(self):
+        """call after the staged materials are written to db"""
+        for key in self.delta['deleted']:
+            self._data.pop(key, None)
+        self._data.update(self._pending)
+        self._pending = {}
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._data, f)
+        os.replace(tmp, self.path)
+
+
+class ScanStats(object):
+    """syscalls made by scan_mat_source"""
+    __slots__ = ('scandir', 'stat')
+
+    def __init__(self):
+        self.scandir = 0
+        self.stat = 0
+
+    def __repr__(self):
+        return '<ScanStats scandir={} stat={}>'.format(self.scandir, self.stat)
+
+
+class MatFolder(object):
+    """one material folder: files = {ext: (path, size, mtime_ns)} of {name}.sbsar/.png/.sbs/.zip"""
+    __slots__ = ('cat', 'name', 'path', 'files')
+    EXTS = ('.sbsar', '.png', '.sbs', '.zip')
+
+    def __init__(self, cat, name, path, files):
+        self.cat = cat
+        self.name = name
+        self.path = path
+        self.files = files
+
+    def file(self, ext):
+        """path of {name}{ext}, whether or not it exists"""
+        f = self.files.get(ext)
+        return f[0] if f else os.path.join(self.path, self.name + ext)
+
+    def __repr__(self):
+        return '<MatFolder {}\\{}>'.format(self.cat, self.name)
+
+
+def _subdirs(path, stats):
+    stats.scandir += 1
+    with os.scandir(path) as it:
+        # is_dir() 使用目录项类型信息, 通常不需要额外stat
+        return [(e.name.lower(), e.path) for e in it if e.is_dir()]
+
+
+def iter_mat_source(source=None, stats=None):
+    """walk source (mat_source by default) once with os.scandir,
+    yield MatFolder in directory order, stats: optional ScanStats
+    """
+    source = source or mat_source
+    stats = stats if stats is not None else ScanStats()
+    for cat, cat_path in _subdirs(source, stats):
+        for n, fd in _subdirs(cat_path, stats):
+            yield scan_folder(cat, n, fd, stats)
+
+
+def scan_folder(cat, n, fd, stats=None):
+    """MatFolder of one material folder fd (category cat, name n, both lower case)"""
+    stats = stats if stats is not None else ScanStats()
+    t = time.perf_counter()
+    files = {}
+    stats.scandir += 1
+    with os.scandir(fd) as it:
+        for e in it:
+            base, ext = os.path.splitext(e.name.lower())
+            if base == n and ext in MatFolder.EXTS and e.is_file():
+                # Windows下DirEntry.stat()不需要系统调用
+                st = e.stat()
+                stats.stat += 1
+                files[ext] = (e.path, st.st_size, st.st_mtime_ns)
+    metrics.observe('scan', time.perf_counter() - t)
+    return MatFolder(cat, n, fd, files)
+
+
+def scan_mat_source(source=None, stats=None):
+    """[MatFolder] of source, see iter_mat_source"""
+    return list(iter_mat_source(source, stats))
+
+
+def _pool_map(func, items, workers=1, chunksize=1, tick=None):
+    """map func over items, in a process pool when workers != 1 (None: all cores,
+    or a running ProcessPoolExecutor to reuse). results keep the order of items
+    tick: with a running pool, called every TICK_SECONDS while waiting for a result
+    """
+    if workers == 1:
+        return map(func, items)
+    if isinstance(workers, ProcessPoolExecutor):
+        if tick is not None:
+            return _map_ticking(workers, func, items, tick)
+        return workers.map(func, items, chunksize=chunksize)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items, chunksize=chunksize))
+
+
+def _map_ticking(pool, func, items, tick):
+    """pool.map (one task per item) calling tick() while a result is not ready,
+    tasks not started yet are cancelled when tick raises
+    """
+    futures = [pool.submit(func, x) for x in items]
+    try:
+        for f in futures:
+            while not wait([f], timeout=TICK_SECONDS)[0]:
+                tick()
+            yield f.result()
+    finally:
+        for f in futures:
+            f.cancel()
+
+
+def _thumb_job(job):
+    """write png as {base}_{size}.{fmt} for each size,
+    return (the sizes that exist, seconds, png bytes read)
+    """
+    png, base, sizes, fmt = job
+    t = time.perf_counter()
+    done = []
+    img = None
+    nbytes = 0
+    for size in sizes:
+        out = '%s_%d.%s' % (base, size, fmt)
+        if not os.path.exists(out):
+            try:
+                if img is None:
+                    img = Image.open(png)
+                    img.load()
+                    nbytes = os.path.getsize(png)
+                    if img.mode not in ('RGB', 'L'):
+                        img = img.convert('RGBA')
+                        bg = Image.new('RGB', img.size, (255, 255, 255))
+                        bg.paste(img, mask=img.split()[3])
+                        img = bg
+                thumb = img.copy()
+                thumb.thumbnail((size, size), Image.LANCZOS)
+                tmp = '%s.%d.tmp' % (out, os.getpid())
+                thumb.save(tmp, 'WEBP' if fmt == 'webp' else 'JPEG', quality=85)
+                os.replace(tmp, out)
+            except Exception as ex:
+                print(f'[THUMB] {png} -> {out}: {ex}')
+                continue
+        done.append(size)
+    return done, time.perf_counter() - t, nbytes
+
+
+def make_thumbs(items, sizes=THUMB_SIZES, fmt=None, workers=1, tick=None):
+    """items: [(png, cat, md5)], write thumb_root/{cat}/{md5}_{size}.{fmt},
+    existing outputs are skipped, return [generated sizes] for each item
+    tick: optional callable() after each item (see iter_mats)
+    """
+    if Image is None:
+        print('[THUMB] Pillow is not installed, skip thumbnails')
+        return [[] for _ in items]
+    fmt = fmt or thumb_format
+    jobs = []
+    for png, cat, md5 in items:
+        fd = os.path.join(thumb_root, cat)
+        os.makedirs(fd, exist_ok=True)
+        jobs.append((png, os.path.join(fd, md5), tuple(sizes), fmt))
+    ret = []
+    for done, seconds, nbytes in _pool_map(_thumb_job, jobs, workers, chunksize=8, tick=tick):
+        metrics.observe('thumbs', seconds, nbytes)
+        ret.append(done)
+        if tick is not None:
+            tick()
+    return ret
+
+
+def _process_mat(job):
+    """get tags, sbsar metadata and md5 for one material folder (runs in a worker process),
+    the stage timings are returned for the parent to record
+    job meta: the stored metadata of this md5 (the sbsar is then not opened) or None
+    """
+    cat, n, sbsar, sbs, sbszip, md5, meta = job
+    t = time.perf_counter()
+    packed = None
+    if meta is None:
+        log(f'read sbsar metadata -> {sbsar}')
+        meta = read_sbsar_meta(sbsar)
+        packed = pack(meta) if meta else None
+    if sbs:
+        log(f'get tags from sbs -> {sbs}')
+        tags = get_mat_tags(sbs)
+    else:
+        tags = meta_tags(meta, n) if meta else []
+    t_tags = time.perf_counter() - t
+
+    t_hash = None
+    if not md5:
+        t = time.perf_counter()
+        md5 = get_md5(sbsar)
+        t_hash = time.perf_counter() - t
+
+    return dict(cat=cat, name=n, md5=md5, tags=tags, sbszip=sbszip, meta=packed, t_tags=t_tags, t_hash=t_hash)
+
+
+class MatRecord(object):
+    """a checked material ready for db, much lighter than a Material with _cat/_tags"""
+    __slots__ = ('id', 'cat', 'name', 'size', 'relative_path', 'has_sbszip', 'thumbnail', 'thumb_sizes', 'md5',
+                 'tags', 'meta', 'state', 'moved_from')
+
+    def __init__(self, cat, name, size, md5, tags, has_sbszip):
+        self.id = None
+        self.cat = cat
+        self.name = name
+        self.size = size
+        self.relative_path = '%s\\%s' % (cat, name)
+        self.has_sbszip = has_sbszip
+        self.md5 = md5
+        self.tags = tags
+        # 将缩略图放入对应category目录下
+        self.thumbnail = '%s\\%s.jpg' % (cat, md5)
+        self.thumb_sizes = None
+        # 新解析的sbsar元数据(matmeta.pack), 已存储时为None
+        self.meta = None
+        # manifest判断的目录状态: 'added', 'modified' (bulk_put按relative_path更新原有行), 无manifest时为None
+        self.state = None
+        # 移动/改名前的relative_path (见put2db), bulk_put更新该行
+        self.moved_from = None
+
+    def toMaterial(self):
+        """Material object (not in db) with the _cat, _tags and _thumb attrs"""
+        matObj = Material(name=self.name,
+                          size=self.size,
+                          relative_path=self.relative_path,
+                          has_sbszip=self.has_sbszip,
+                          thumbnail=self.thumbnail,
+                          thumb_sizes=self.thumb_sizes,
+                          md5=self.md5,
+                          )
+        # addtion attrs
+        matObj._cat = self.cat
+        matObj._tags = self.tags
+        matObj._thumb = self.thumbnail
+        return matObj
+
+    def __repr__(self):
+        return '<MatRecord {}>'.format(self.name)
 
-    mats = dict.fromkeys(cats)
 
-    for cat in cats:
-        mats[cat] = getMats(cat)
+def _run_mat_jobs(jobs, stats, to_zip, workers, cache, codec, level, thumbs, tick=None):
+    """zip, tags/md5 and thumbnail stages for a chunk of jobs, return [MatRecord]
+    tick: optional callable() after each result of a stage
+    """
+    if to_zip:
+        zips, report = zip_files([jobs[i][3] for i in to_zip], codec, level, workers, tick)
+        for i, z in zip(to_zip, zips):
+            jobs[i][4] = z
+            if z:
+                log(f'new sbszip: {z}')
+        print(f'zip: {report}')
+
+    # 已存储元数据的md5不再打开sbsar (需要app context, 否则全部重新解析)
+    known = [j[5] for j in jobs if j[5]]
+    stored = load_meta(known) if known and has_app_context() else {}
+    for j in jobs:
+        j[6] = stored.get(j[5])
+    metrics.inc('meta_reused', sum(1 for j in jobs if j[6] is not None))
+
+    # 耗时操作(tags, md5)可并行, 结果顺序与jobs一致
+    records = []
+    pngs = []
+    results = _pool_map(_process_mat, jobs, workers, chunksize=8, tick=tick)
+    for r, (sbsar, size, mtime_ns, png, sbs_size, state) in zip(results, stats):
+        if tick is not None:
+            tick()
+        metrics.observe('tags', r['t_tags'], size if sbs_size is None else sbs_size)
+        if r['t_hash'] is not None:
+            metrics.observe('hash', r['t_hash'], size)
+        if cache is not None:
+            cache.put(sbsar, size, mtime_ns, r['md5'])
+        if r['sbszip']:
+            log(f'[sbs] {r["sbszip"]}')
+        rec = MatRecord(r['cat'], r['name'], size, r['md5'], r['tags'], r['sbszip'] is not None)
+        rec.meta = r['meta']
+        rec.state = state
+        records.append(rec)
+        if png and rec.md5:
+            pngs.append((png, rec))
 
+    if thumbs and pngs:
+        made = make_thumbs([(p, m.cat, m.md5) for p, m in pngs], workers=workers, tick=tick)
+        for (png, rec), sizes in zip(pngs, made):
+            if sizes:
+                rec.thumb_sizes = ','.join(str(x) for x in sizes)
+                rec.thumbnail = '%s\\%s_%d.%s' % (rec.cat, rec.md5, sizes[-1], thumb_format)
+    return records
+
+
+def iter_mats(workers=1, cache=None, manifest=None, codec=None, level=None, thumbs=True, chunk=DB_BATCH,
+              skip=None, source=None, folders=None, tick=None, gone=()):
+    """check mat_source and yield a MatRecord per valid material folder,
+    folders are processed chunk at a time so memory does not grow with the library
+    workers: number of processes for zip/tags/md5/thumbnails, None for all cores
+    cache: optional HashCache, unchanged .sbsar files are not hashed again
+    manifest: optional Manifest, only new or modified folders are returned (see manifest.delta)
+    codec, level: compression of new sbs zips (see zip_files)
+    thumbs: generate THUMB_SIZES thumbnails from {name}.png (see make_thumbs)
+    skip: optional set of .sbsar paths to leave out, e.g. load_duplicates()
+    source: material folder to check instead of mat_source
+    folders: check only these MatFolders instead of scanning source (see watch.py),
+        gone: manifest keys of folders that disappeared meanwhile (deleted or moved away)
+    tick: optional callable() for each scanned folder, each result of the zip/tags/thumbnail stages and
+        every TICK_SECONDS while waiting for one, not only once per yielded record;
+        raise in it to stop (see put2db progress)
+    """
+    scan = ScanStats()
     err_sbsar = []
     err_thumb = []
-    sbs_zips = []
-    matObjs = []
-    for k, v in mats.items():
-        print(f'{k}: {v}')
-        for n in v:
-            fd = os.path.join(mat_source, k, n)
-            # print(fd)
-            sbsar = os.path.join(fd, '%s.sbsar' % n)
-            if not os.path.exists(sbsar):
-                err_sbsar.append(sbsar)
-                continue
+    jobs = []
+    stats = []
+    to_zip = []
+    count = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        if folders is not None:
+            found = sorted(folders, key=lambda x: x.cat)
+        else:
+            found = iter_mat_source(source or mat_source, scan)
+        for k, group in groupby(found, key=lambda x: x.cat):
+            group = list(group)
+            log(f'{k}: {[x.name for x in group]}')
+            for f in group:
+                n = f.name
+                if tick is not None:
+                    tick()
+                state = None
+                if manifest is not None:
+                    key = '%s\\%s' % (k, n)
+                    sig = Manifest.signature(f)
+                    state = manifest.changed(key, sig)
+                    if state is None:
+                        continue
+                if '.sbsar' not in f.files:
+                    err_sbsar.append(f.file('.sbsar'))
+                    continue
+                png = f.files.get('.png')
+                if not png:
+                    err_thumb.append(f.file('.png'))
+
+                sbsar, size, mtime_ns = f.files['.sbsar']
+                if skip and sbsar in skip:
+                    log(f'[DUP] {sbsar}')
+                    continue
+                md5 = cache.get(sbsar, size, mtime_ns) if cache is not None else None
+                sbs = f.files.get('.sbs')
+                sbszip = f.files.get('.zip')
+                # 没有zip或zip比sbs旧
+                if sbs and (not sbszip or sbszip[2] < sbs[2]):
+                    to_zip.append(len(jobs))
+                    sbszip = None
+                jobs.append([k, n, sbsar, sbs and sbs[0], sbszip and sbszip[0], md5, None])
+                if manifest is not None:
+                    manifest.stage(key, sig, state)
+                stats.append((sbsar, size, mtime_ns, png and png[0], sbs and sbs[1], state))
 
-            thumb = os.path.join(fd, '%s.png' % n)
-            if not os.path.exists(thumb):
-                err_thumb.append(thumb)
-
-            # has sbs
-            sbs = os.path.join(fd, '%s.sbs' % n)
-            sbszip = os.path.join(fd, '%s.zip' % n)
-            if os.path.exists(sbszip):
-                sbs_zips.append(sbszip)
-
-            if os.path.exists(sbs) and not os.path.exists(sbszip):
-                sbszip = zip_file(sbs)
-                if os.path.exists(sbszip):
-                    sbs_zips.append(sbszip)
-                    print(f'new sbszip: {sbszip}')
-
-            tags = []
-            if os.path.exists(sbs):
-                print(f'get tags from sbs -> {sbs}')
-                tags = get_mat_tags(sbs)
-            elif os.path.exists(sbsar):
-                print(f'get tags from sbsar -> {sbsar}')
-                tags = get_mat_tags(sbsar)
-
-            matObj = Material(name=n,
-                              size=os.path.getsize(sbsar),
-                              relative_path='%s\\%s' % (k, n),
-                              has_sbszip=os.path.exists(sbszip),
-                              )
-            # addtion attrs
-            matObj._cat = k
-            matObj._tags = tags
-            matObj.md5 = get_md5(sbsar)
-            # 将缩略图放入对应category目录下
-            matObj._thumb = '%s\\%s.jpg' % (k, matObj.md5)
-            matObj.thumbnail = matObj._thumb
-            matObjs.append(matObj)
+                if len(jobs) >= chunk:
+                    records = _run_mat_jobs(jobs, stats, to_zip, pool or 1, cache, codec, level, thumbs, tick)
+                    count += len(records)
+                    yield from records
+                    jobs, stats, to_zip = [], [], []
+        if jobs:
+            records = _run_mat_jobs(jobs, stats, to_zip, pool or 1, cache, codec, level, thumbs, tick)
+            count += len(records)
+            yield from records
+    except BaseException:
+        if pool is not None:
+            # 被tick中断(取消)时不等待工作进程中正在执行的任务 (zip/缩略图均先写临时文件再改名)
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
+    print(f'scan: {count} materials, {scan}')
     for e in err_sbsar:
         print(f'[ERR SBSAR] {e}')
     for e in err_thumb:
         print(f'[ERR THUMB] {e}')
-    print(f'sbs count: {len(sbs_zips)}')
-    for sbs in sbs_zips:
-        print(f'[sbs] {sbs}')
+    if cache is not None:
+        cache.save()
+        metrics.inc('hash_cache_hits', cache.hits)
+        metrics.inc('hash_cache_misses', cache.misses)
+        print(f'md5 cache: {cache.stats()}')
+    if manifest is not None:
+        delta = manifest.finish_scan(partial=folders is not None, gone=gone)
+        print('delta: added {} modified {} deleted {} unchanged {}'.format(
+            len(delta['added']), len(delta['modified']), len(delta['deleted']), delta['unchanged']))
 
-    return matObjs
 
+def check_get_mats(workers=1, cache=None, manifest=None, codec=None, level=None, thumbs=True):
+    """check mat_source and return Material objects (not in db yet), see iter_mats"""
+    return [r.toMaterial() for r in iter_mats(workers, cache, manifest, codec, level, thumbs)]
 
-def put2db():
-    mats = check_get_mats()
-    for mat in mats:
-        if MatMD5.query.filter_by(md5=mat.md5).first():
-            print(f'[EXIST] {mat.md5} {mat}')
+
+def _name_ids(col_name, col_id, names):
+    """{name: id} of rows whose name is in names"""
+    ret = {}
+    names = list(names)
+    for i in range(0, len(names), DB_BATCH):
+        q = db.session.query(col_name, col_id).filter(col_name.in_(names[i:i + DB_BATCH]))
+        ret.update(q)
+    return ret
+
+
+def _insert_names(table, col_name, col_id, names, ids):
+    """multi-row insert names missing from ids ({name: id}), then update ids"""
+    missing = sorted(set(names) - set(ids))
+    if missing:
+        db.session.execute(table.insert(), [{col_name.key: n} for n in missing])
+        ids.update(_name_ids(col_name, col_id, missing))
+        lookup_cache.invalidate()
+
+
+def _path_rows(paths):
+    """{relative_path: (id, md5)} of the materials at paths"""
+    ret = {}
+    paths = list(paths)
+    for i in range(0, len(paths), DB_BATCH):
+        q = db.session.query(Material.relative_path, Material.id, Material.md5) \
+            .filter(Material.relative_path.in_(paths[i:i + DB_BATCH]))
+        ret.update((p, (mat_id, md5)) for p, mat_id, md5 in q)
+    return ret
+
+
+def _delete_rows(ids, md5s):
+    """delete materials ids with their tag links, and the mat_md5 rows of md5s (caller commits)"""
+    if ids:
+        db.session.execute(t_mat_tag.delete().where(t_mat_tag.c.mat_id.in_(ids)))
+        db.session.execute(Material.__table__.delete().where(Material.id.in_(ids)))
+    if md5s:
+        db.session.execute(MatMD5.__table__.delete().where(MatMD5.md5.in_(md5s)))
+
+
+def bulk_put(mats, exist=None):
+    """write MatRecords from iter_mats with batched multi-row INSERTs,
+    one transaction per DB_BATCH materials (instead of setCategory/setTags/setMD5 per object)
+    records of modified folders update the material at their relative_path (or moved_from, used_times is kept),
+    exist: optional list, new records skipped because their md5 is in db are appended (see put2db moves)
+    return the records written
+    """
+    # 分类与标签数量少, 全部预加载
+    cats = dict(db.session.query(MatCategory.name, MatCategory.id))
+    tags = dict(db.session.query(MatTag.name, MatTag.id))
+    written = []
+    removed = []
+    for i in range(0, len(mats), DB_BATCH):
+        batch = mats[i:i + DB_BATCH]
+        exists = _name_ids(MatMD5.md5, MatMD5.id, [m.md5 for m in batch])
+        old = _path_rows(m.moved_from or m.relative_path for m in batch if m.state == 'modified')
+        todo = {}
+        updates = []
+        # 修改后与其他材质重复的原有行
+        drop = []
+        seen = set()
+        for mat in batch:
+            row = old.get(mat.moved_from or mat.relative_path)
+            if not mat.md5 or mat.md5 in seen:
+                log(f'[EXIST] {mat.md5} {mat}')
+                continue
+            seen.add(mat.md5)
+            if row is not None and (mat.md5 == row[1] or mat.md5 not in exists):
+                updates.append((row, mat))
+            elif mat.md5 in exists:
+                log(f'[EXIST] {mat.md5} {mat}')
+                if row is not None:
+                    drop.append(row)
+                elif exist is not None:
+                    exist.append(mat)
+            else:
+                todo[mat.md5] = mat
+        # 已入库的材质也保存新解析的元数据(例如升级META_VERSION后重新入库)
+        packed = {m.md5: m.meta for m in batch if m.md5 and m.meta}
+        if not todo and not updates and not drop:
+            if packed:
+                save_meta(packed)
+                db.session.commit()
             continue
-        mat.setCategory(mat._cat)
-        mat.setTags(mat._tags)
-        mat.setMD5(mat.md5)
-        db.session.add(mat)
-    db.session.commit()
-    print(mats)
-    return mats
+        t = time.perf_counter()
+        mats_ = list(todo.values()) + [m for _, m in updates]
+
+        _insert_names(MatCategory.__table__, MatCategory.name, MatCategory.id,
+                      [m.cat.lower() for m in mats_], cats)
+        _insert_names(MatTag.__table__, MatTag.name, MatTag.id,
+                      [t.lower() for m in mats_ for t in m.tags], tags)
+        new_md5 = list(todo) + [m.md5 for row, m in updates if m.md5 != row[1]]
+        if new_md5:
+            db.session.execute(MatMD5.__table__.insert(), [{'md5': m} for m in new_md5])
+            exists.update(_name_ids(MatMD5.md5, MatMD5.id, new_md5))
+
+        def values(mat):
+            return dict(name=mat.name, relative_path=mat.relative_path, size=mat.size, has_sbszip=bool(mat.has_sbszip), thumbnail=mat.thumbnail,
+                        thumb_sizes=mat.thumb_sizes, md5=mat.md5, md5_id=exists[mat.md5],
+                        cat_id=cats[mat.cat.lower()])
+
+        if todo:
+            db.session.execute(Material.__table__.insert(),
+                               [dict(values(mat), used_times=0) for mat in todo.values()])
+            mat_ids = _name_ids(Material.md5, Material.id, todo)
+            for mat in todo.values():
+                mat.id = mat_ids[mat.md5]
+        if updates:
+            db.session.execute(Material.__table__.update().where(Material.id == bindparam('_id')),
+                               [dict(values(mat), _id=row[0]) for row, mat in updates])
+            for row, mat in updates:
+                mat.id = row[0]
+            # 原有标签全部替换
+            db.session.execute(t_mat_tag.delete().where(t_mat_tag.c.mat_id.in_([row[0] for row, _ in updates])))
+        _delete_rows([row[0] for row in drop],
+                     [row[1] for row in drop] + [row[1] for row, m in updates if m.md5 != row[1]])
+
+        links = set()
+        for mat in mats_:
+            links.update((mat.id, tags[t.lower()]) for t in mat.tags)
+        if links:
+            db.session.execute(t_mat_tag.insert(), [dict(mat_id=m, tag_id=t) for m, t in sorted(links)])
+        save_meta(packed)
+        db.session.commit()
+        metrics.observe('db', time.perf_counter() - t, items=len(mats_))
+        written.extend(mats_)
+        removed.extend([row[0] for row in drop] + [row[0] for row, _ in updates])
+    tag_index.remove(removed)
+    tag_index.add(written)
+    return written
+
+
+def find_moves(mats, paths):
+    """records among mats (skipped by bulk_put as existing) whose md5 belongs to a material at one of paths
+    (folders gone from mat_source): the folder was moved or renamed, the records are marked to update
+    that material (moved_from), return them
+    """
+    rows = _path_rows(paths)
+    by_md5 = {md5: p for p, (_, md5) in rows.items() if md5}
+    moved = []
+    for mat in mats:
+        p = by_md5.pop(mat.md5, None)
+        if p is not None:
+            mat.state = 'modified'
+            mat.moved_from = p
+            moved.append(mat)
+            log(f'[MOVE] {p} -> {mat.relative_path}')
+    return moved
+
+
+def bulk_delete(paths):
+    """delete the materials at relative_paths (folders gone from mat_source, see Manifest.delta),
+    with their tag links and mat_md5 rows, return the number deleted
+    """
+    rows = list(_path_rows(paths).values())
+    for i in range(0, len(rows), DB_BATCH):
+        batch = rows[i:i + DB_BATCH]
+        _delete_rows([r[0] for r in batch], [r[1] for r in batch if r[1]])
+        db.session.commit()
+    for p in paths:
+        log(f'[DELETE] {p}')
+    tag_index.remove([r[0] for r in rows])
+    return len(rows)
+
+
+def _meta_job(sbsar):
+    meta = read_sbsar_meta(sbsar)
+    return pack(meta) if meta else None
+
+
+def backfill_meta(source=None, workers=1):
+    """parse and store the metadata of materials in db that have none yet (or an old META_VERSION),
+    the .sbsar is found at source/relative_path/name.sbsar, return the number stored
+    """
+    source = source or mat_source
+    mats = db.session.query(Material.md5, Material.relative_path, Material.name) \
+        .outerjoin(MatMeta, (MatMeta.md5 == Material.md5) & (MatMeta.version == META_VERSION)) \
+        .filter(MatMeta.md5.is_(None), Material.md5.isnot(None)).all()
+    count = 0
+    for i in range(0, len(mats), DB_BATCH):
+        batch = mats[i:i + DB_BATCH]
+        paths = [os.path.join(source, rel.replace('\\', os.sep), name + '.sbsar') for _, rel, name in batch]
+        t = time.perf_counter()
+        packed = {md5: data for (md5, _, _), data in zip(batch, _pool_map(_meta_job, paths, workers, chunksize=8))
+                  if data}
+        metrics.observe('meta', time.perf_counter() - t, items=len(batch))
+        count += save_meta(packed)
+        db.session.commit()
+        log(f'meta {count}/{len(mats)}')
+    print(f'meta: {count} of {len(mats)} materials stored')
+    return count
+
+
+# Linux FICLONE ioctl: 在btrfs/xfs等文件系统上共享数据块(reflink), 不复制数据
+FICLONE = 0x40049409
+# 文件系统/平台不支持某种复制方式时的错误, 换下一种方式
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM,
+                getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.EBADF)
+# (方式, 源设备, 目标设备) 已知不支持的组合, 不再尝试
+_unsupported = set()
+
+
+def _reflink(src, dst, size):
+    import fcntl
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_range(src, dst, size):
+    done = 0
+    while done < size:
+        n = os.copy_file_range(src.fileno(), dst.fileno(), min(size - done, COPY_CHUNK))
+        if n == 0:
+            break
+        done += n
+
+
+def _sendfile(src, dst, size):
+    done = 0
+    while done < size:
+        n = os.sendfile(dst.fileno(), src.fileno(), done, min(size - done, COPY_CHUNK))
+        if n == 0:
+            break
+        done += n
+
+
+def _buffered(src, dst, size):
+    shutil.copyfileobj(src, dst, COPY_CHUNK)
+
+
+# 依次尝试, buffered 总是可用
+COPY_METHODS = [(name, func) for name, func, ok in (
+    ('reflink', _reflink, os.name == 'posix' and hasattr(os, 'uname') and os.uname().sysname == 'Linux'),
+    ('copy_file_range', _copy_range, hasattr(os, 'copy_file_range')),
+    ('sendfile', _sendfile, hasattr(os, 'sendfile') and os.name == 'posix'),
+    ('buffered', _buffered, True)) if ok]
+
+
+def copy_asset(src, dst, link=False):
+    """copy src to dst (written to a temp file, then renamed) with the cheapest method that works:
+    hardlink (only when link, dst then shares the inode with src), reflink, copy_file_range, sendfile, buffered.
+    mtime is copied so an unchanged dst can be recognised later, return the method used
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    src_dev = os.stat(src).st_dev
+    dst_dev = os.stat(os.path.dirname(dst)).st_dev
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    if link and ('link', src_dev, dst_dev) not in _unsupported:
+        try:
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+            return 'link'
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED:
+                raise
+            _unsupported.add(('link', src_dev, dst_dev))
+    size = os.path.getsize(src)
+    try:
+        for name, func in COPY_METHODS:
+            if (name, src_dev, dst_dev) in _unsupported:
+                continue
+            with open(src, 'rb') as fs, open(tmp, 'wb') as fd:
+                try:
+                    func(fs, fd, size)
+                except OSError as ex:
+                    if ex.errno not in _UNSUPPORTED or name == 'buffered':
+                        raise
+                    _unsupported.add((name, src_dev, dst_dev))
+                    continue
+            if os.path.getsize(tmp) != size:
+                raise OSError(errno.EIO, 'short copy with %s' % name, src)
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+            return name
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _up_to_date(src, dst):
+    """dst is src (hardlink) or has the same size and mtime (copy_asset copies mtime)"""
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return (s.st_ino == d.st_ino and s.st_dev == d.st_dev) or \
+        (s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns)
+
+
+def _publish_job(job):
+    """copy one asset unless up to date, verify it against md5 when given,
+    return (dst, method or 'skip', bytes copied, seconds, error)
+    """
+    src, dst, md5, link = job
+    t = time.perf_counter()
+    try:
+        if _up_to_date(src, dst):
+            return dst, 'skip', 0, time.perf_counter() - t, None
+        method = copy_asset(src, dst, link)
+        if md5 and get_md5(dst) != md5:
+            os.remove(dst)
+            return dst, method, 0, time.perf_counter() - t, 'md5 mismatch'
+        return dst, method, os.path.getsize(dst), time.perf_counter() - t, None
+    except OSError as ex:
+        return dst, None, 0, time.perf_counter() - t, str(ex)
+
+
+def _publish_jobs(mat, root, source, link):
+    """(src, dst, md5, link) for the files of one Material row"""
+    rel = mat.relative_path.replace('\\', os.sep)
+    jobs = [(os.path.join(source, rel, mat.name + '.sbsar'), os.path.join(root, rel, mat.name + '.sbsar'),
+             mat.md5, link)]
+    if mat.has_sbszip:
+        jobs.append((os.path.join(source, rel, mat.name + '.zip'), os.path.join(root, rel, mat.name + '.zip'),
+                     None, link))
+    png = os.path.join(source, rel, mat.name + '.png')
+    if os.path.exists(png):
+        jobs.append((png, os.path.join(root, rel, mat.name + '.png'), None, link))
+    # 缩略图按 category/md5 存放
+    if mat.thumbnail and mat.thumb_sizes:
+        cat = mat.thumbnail.replace('\\', '/').split('/')[0]
+        fmt = os.path.splitext(mat.thumbnail)[1]
+        for size in mat.thumb_sizes.split(','):
+            f = '%s_%s%s' % (mat.md5, size, fmt)
+            jobs.append((os.path.join(thumb_root, cat, f), os.path.join(root, 'thumbs', cat, f), None, link))
+    return jobs
+
+
+def publish(root=None, source=None, workers=PUBLISH_WORKERS, link=False):
+    """copy the assets of every material in db from source (mat_source) to root (publish_root),
+    laid out as root/relative_path/name.ext and root/thumbs/category/md5_size.ext;
+    unchanged files are skipped, .sbsar copies are checked against Material.md5.
+    复制是I/O操作(系统调用期间释放GIL), 使用有界线程池而不是进程池
+    return a report
+    """
+    root = root or publish_root
+    source = source or mat_source
+    t0 = time.perf_counter()
+    report = dict(root=root, files=0, bytes=0, methods={}, errors=[])
+    q = db.session.query(Material.relative_path, Material.name, Material.md5, Material.has_sbszip,
+                         Material.thumbnail, Material.thumb_sizes).order_by(Material.id)
+    with ThreadPoolExecutor(max_workers=workers or None) as pool:
+        mats = q.all()
+        for i in range(0, len(mats), DB_BATCH):
+            jobs = [j for m in mats[i:i + DB_BATCH] for j in _publish_jobs(m, root, source, link)]
+            for dst, method, nbytes, seconds, error in pool.map(_publish_job, jobs):
+                report['files'] += 1
+                if error:
+                    print(f'[PUBLISH] {dst}: {error}')
+                    report['errors'].append(dict(file=dst, error=error))
+                    continue
+                report['methods'][method] = report['methods'].get(method, 0) + 1
+                report['bytes'] += nbytes
+                if method != 'skip':
+                    metrics.observe('publish', seconds, nbytes)
+                log(f'[{method}] {dst}')
+    wall = time.perf_counter() - t0
+    report['seconds'] = round(wall, 3)
+    report['mb_per_s'] = round(report['bytes'] / 2 ** 20 / wall, 2) if wall else None
+    print('publish: {} files, {} bytes, {} errors, {}'.format(
+        report['files'], report['bytes'], len(report['errors']), report['methods']))
+    return report
+
+
+def put2db(workers=1, use_cache=True, incremental=False, chunk=DB_BATCH, metrics_out=None, duplicates=None,
+           source=None, progress=None, folders=None, gone=()):
+    """check mat_source (or source) and write new materials to db, chunk records at a time,
+    incremental: skip folders unchanged since the last incremental put2db (see Manifest),
+        modified folders update their material, moved/renamed ones too (matched by md5),
+        deleted folders are removed from db
+    duplicates: path of a find_source_duplicates report, duplicate .sbsar copies are skipped
+    metrics_out: write the stage metrics of this run there (.prom: Prometheus text, else json)
+    progress: optional callable(checked, written) called often during every stage, raise in it to stop
+        (written chunks stay in db, the manifest is not committed)
+    folders, gone: write only these MatFolders, delete only the gone keys (see iter_mats)
+    return the number of materials written
+    """
+    base = metrics.snapshot()
+    manifest = Manifest(source_file(manifest_file, source)) if incremental else None
+    cache = HashCache(source_file(md5_cache_file, source)) if use_cache else None
+    skip = load_duplicates(duplicates) if duplicates else None
+    count = 0
+    checked = 0
+    batch = []
+    # md5已存在而跳过的新目录, 可能是移动/改名的目录
+    exist = [] if manifest is not None else None
+    # 各阶段处理过程中也检查进度/取消, 不必等到一批(chunk)全部完成
+    tick = (lambda: progress(checked, count)) if progress is not None else None
+    for rec in iter_mats(workers, cache, manifest, chunk=chunk, skip=skip, source=source, folders=folders,
+                         tick=tick, gone=gone):
+        batch.append(rec)
+        checked += 1
+        if len(batch) >= chunk:
+            count += len(bulk_put(batch, exist))
+            batch = []
+            log(f'put {count} materials')
+        if progress is not None:
+            progress(checked, count)
+    if batch:
+        count += len(bulk_put(batch, exist))
+    if progress is not None:
+        progress(checked, count)
+    print(f'put {count} materials')
+    if manifest is not None:
+        deleted = manifest.delta['deleted']
+        if deleted and exist:
+            # 先把移动/改名的目录更新到原有行, 再删除其余消失的目录
+            moved = find_moves(exist, deleted)
+            if moved:
+                count += len(bulk_put(moved))
+                done = {m.moved_from for m in moved}
+                deleted = [p for p in deleted if p not in done]
+                print(f'moved {len(moved)} materials')
+        if deleted:
+            print(f'deleted {bulk_delete(deleted)} materials')
+        manifest.commit()
+    # 只报告本次入库 (web/watch进程中metrics是进程内累计值)
+    run = metrics.since(base)
+    for stage, m in run.report()['stages'].items():
+        print(f'[{stage}] items {m["items"]} bytes {m["bytes"]} seconds {m["seconds"]}')
+    metrics_out = metrics_out or os.getenv('MAT_METRICS_OUT')
+    if metrics_out:
+        run.save(metrics_out)
+    return count
 
 
 if __name__ == '__main__':
     normalize_folder_name(mat_source, only_remove_chars=[' ', '#', '-', "'"])
 
-    # mats = put2db()
-    # print(len(mats))
+    # print(put2db())
     # get_mat_tags(r'E:\mat\ceramic\ceramic_foam\ceramic_foam.sbs')
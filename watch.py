@@ -0,0 +1,285 @@
+# coding:utf-8
+# author: jason.li
+"""
+监视模式入库::
+    持续监视 mat_source, 新增或修改的材质目录在 STABLE_SECONDS 内文件大小/mtime 不再变化后
+    (复制完成), 每次最多 WATCH_BATCH 个目录写入数据库; 标签索引与导航缓存由 tools.bulk_put 同步更新,
+    从复制完成到可搜索通常只需几秒
+    有 watchdog 时 (pip install watchdog, Linux下即inotify) 只重新扫描有事件的目录,
+    另每 RESCAN_SECONDS 秒全量扫描一次防止漏掉事件; 没有时每 POLL_SECONDS 秒用 os.scandir 全量对比
+    与 put2db(incremental=True) 共用 manifest, 已入库且未变化的目录不会重复处理
+    消失的目录(删除、移动或改名)在没有仍在复制中的目录时与就绪目录一起交给 put2db(gone=...),
+    移动/改名的目录按md5更新原有行, 其余删除
+    一批入库失败时逐个目录重试: 数据库错误(连接、锁超时)在 RETRY_SECONDS 后重试, 间隔每次翻倍;
+    其他错误只标记出错的目录, 该目录文件变化前不再处理
+    运行期间登记为 watch 任务 (见jobs.py), 同一 mat_source 的其他入库会被拒绝, 可通过 /api/jobs/<id>/cancel 停止
+
+    flask watch [--workers 4]
+"""
+import os
+import time
+import threading
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import tools
+from tools import Manifest, ScanStats, iter_mat_source, scan_folder, log
+
+try:
+    # 可选依赖 (pip install watchdog)
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+POLL_SECONDS = 1.0
+STABLE_SECONDS = 2.0
+RESCAN_SECONDS = 300
+WATCH_BATCH = 20
+# 数据库错误后重试的初始间隔(秒), 每次翻倍, 最长 RESCAN_SECONDS
+RETRY_SECONDS = 5
+
+
+def _transient(ex):
+    """errors not caused by the folder itself (database down, lock timeout), retried later"""
+    return isinstance(ex, SQLAlchemyError)
+
+
+def _key(folder):
+    return '%s\\%s' % (folder.cat, folder.name)
+
+
+class _DirtyFolders(FileSystemEventHandler):
+    """collect the material folders (and new category folders) touched by file system events"""
+
+    def __init__(self, source):
+        self.source = os.path.abspath(source)
+        self._lock = threading.Lock()
+        self._folders = set()
+        self._cats = set()
+
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if not path:
+                continue
+            if isinstance(path, bytes):
+                path = os.fsdecode(path)
+            rel = os.path.relpath(path, self.source).split(os.sep)
+            if rel[0] in ('.', '..') or rel[0].startswith('..'):
+                continue
+            with self._lock:
+                if len(rel) == 1:
+                    self._cats.add(rel[0])
+                else:
+                    self._folders.add((rel[0], rel[1]))
+
+    def take(self):
+        """(set of (category dir, material dir), set of category dirs) since the last take"""
+        with self._lock:
+            folders, cats, self._folders, self._cats = self._folders, self._cats, set(), set()
+        return folders, cats
+
+
+class FolderWatcher(object):
+    """find new/changed material folders that are stable and ingest them in small batches"""
+
+    def __init__(self, source=None, workers=1, stable=STABLE_SECONDS, poll=POLL_SECONDS, batch=WATCH_BATCH,
+                 events=True):
+        self.source = source or tools.mat_source
+        self.workers = workers
+        self.stable = stable
+        self.poll = poll
+        self.batch = batch
+        self.events = events and Observer is not None
+        self.ingested = 0
+        self.batches = 0
+        # key -> (signature, 签名首次出现的时间, MatFolder)
+        self._candidates = {}
+        # 入库失败的目录签名, 文件变化前不再重试
+        self._failed = {}
+        # 因数据库错误待重试的目录: key -> (失败次数, 下次重试时间)
+        self._retry = {}
+        # 已入库但目录已消失的 manifest key
+        self._gone = set()
+        self._manifest = Manifest(tools.source_file(tools.manifest_file, self.source))
+        self._handler = None
+        self._observer = None
+        self._rescan_at = 0
+
+    def start(self):
+        if self.events:
+            self._handler = _DirtyFolders(self.source)
+            self._observer = Observer()
+            self._observer.schedule(self._handler, self.source, recursive=True)
+            self._observer.start()
+        print('[WATCH] {} ({})'.format(self.source, 'file system events' if self.events else 'polling'))
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def _changed_folders(self, now):
+        """MatFolders to check in this tick"""
+        if not self.events or now >= self._rescan_at:
+            self._rescan_at = now + RESCAN_SECONDS
+            if self._handler is not None:
+                self._handler.take()
+            found = list(iter_mat_source(self.source))
+            self._gone = self._manifest.keys() - {_key(f) for f in found}
+            return found
+        folders, cats = self._handler.take()
+        known = None
+        for cat in cats:
+            cat_path = os.path.join(self.source, cat)
+            if os.path.isdir(cat_path):
+                with os.scandir(cat_path) as it:
+                    folders.update((cat, e.name) for e in it if e.is_dir())
+            else:
+                # 整个分类目录被删除或移走
+                known = self._manifest.keys() if known is None else known
+                self._gone.update(k for k in known if k.startswith(cat.lower() + '\\'))
+        for c, n in folders:
+            key = '%s\\%s' % (c.lower(), n.lower())
+            if not os.path.isdir(os.path.join(self.source, c, n)) and self._manifest.known(key) is not None:
+                self._gone.add(key)
+        # 未稳定的目录即使没有新事件也要继续检查
+        found = {os.path.join(self.source, c, n) for c, n in folders}
+        found.update(f.path for _, _, f in self._candidates.values())
+        ret = []
+        for fd in sorted(found):
+            if os.path.isdir(fd):
+                cat_path, n = os.path.split(fd)
+                ret.append(scan_folder(os.path.basename(cat_path).lower(), n.lower(), fd, ScanStats()))
+        return ret
+
+    def ready(self, now=None):
+        """MatFolders whose files did not change for stable seconds and are not ingested yet"""
+        now = time.time() if now is None else now
+        ready = []
+        for f in self._changed_folders(now):
+            key = _key(f)
+            self._gone.discard(key)
+            sig = Manifest.signature(f)
+            if '.sbsar' not in f.files or self._manifest.known(key) == sig or self._failed.get(key) == sig:
+                self._candidates.pop(key, None)
+                continue
+            c = self._candidates.get(key)
+            if c is None or c[0] != sig:
+                # 新出现或仍在复制中, 重新计时
+                self._candidates[key] = (sig, now, f)
+                log(f'[WATCH] changed {key}')
+            elif now - c[1] >= self.stable and now >= self._retry.get(key, (0, 0))[1]:
+                ready.append(f)
+        return ready
+
+    def gone(self, ready):
+        """manifest keys of vanished folders to delete (or match as moved) together with ready,
+        none while another folder is still being copied (it may be where a folder was moved to)
+        """
+        keys = {_key(f) for f in ready}
+        if any(k not in keys for k in self._candidates):
+            return []
+        return sorted(self._gone)
+
+    def _put(self, batch, gone=()):
+        """put2db one batch, return (materials written, the exception or None)"""
+        t = time.perf_counter()
+        try:
+            n = tools.put2db(self.workers, incremental=True, chunk=self.batch, source=self.source,
+                              folders=batch, gone=gone)
+        except Exception as ex:
+            tools.db.session.rollback()
+            return 0, ex
+        finally:
+            # put2db已提交manifest, 重新载入
+            self._manifest = Manifest(tools.source_file(tools.manifest_file, self.source))
+        self.batches += 1
+        print('[WATCH] {} folders, {} materials written in {:.2f}s'.format(len(batch), n, time.perf_counter() - t))
+        return n, None
+
+    def _done(self, folder):
+        key = _key(folder)
+        self._candidates.pop(key, None)
+        self._retry.pop(key, None)
+
+    def _fail(self, folder, ex, now):
+        """database errors: retry later (the folder stays a candidate), others: skip the folder until it changes"""
+        key = _key(folder)
+        if _transient(ex):
+            attempts = self._retry.get(key, (0, 0))[0] + 1
+            delay = min(RETRY_SECONDS * 2 ** (attempts - 1), RESCAN_SECONDS)
+            self._retry[key] = (attempts, now + delay)
+            log(f'[WATCH] {key} retry in {delay}s')
+        else:
+            self._failed[key] = Manifest.signature(folder)
+            self._candidates.pop(key, None)
+            self._retry.pop(key, None)
+            print(f'[WATCH] {key} failed, skipped until its files change: {ex}')
+
+    def ingest(self, folders, now=None, gone=()):
+        """write folders to db, batch at a time, return the number of materials written
+        a failed batch is retried folder by folder, see _fail
+        gone: vanished folder keys (see gone()), written with all folders in one put2db so moves are matched
+        """
+        now = time.time() if now is None else now
+        count = 0
+        if gone:
+            n, ex = self._put(folders, gone)
+            if ex is None:
+                self._gone.difference_update(gone)
+                for f in folders:
+                    self._done(f)
+                self.ingested += n
+                return n
+            print(f'[WATCH] {len(folders)} folders and {len(gone)} vanished ones failed ({ex})')
+            if _transient(ex):
+                for f in folders:
+                    self._fail(f, ex, now)
+                return 0
+        for i in range(0, len(folders), self.batch):
+            batch = folders[i:i + self.batch]
+            n, ex = self._put(batch)
+            count += n
+            if ex is None:
+                for f in batch:
+                    self._done(f)
+                continue
+            if len(batch) == 1 or _transient(ex):
+                if _transient(ex):
+                    print(f'[WATCH] database error, retry {len(batch)} folders later: {ex}')
+                for f in batch:
+                    self._fail(f, ex, now)
+                continue
+            print(f'[WATCH] {len(batch)} folders failed ({ex}), retry one by one')
+            for j, f in enumerate(batch):
+                n, ex = self._put([f])
+                count += n
+                if ex is None:
+                    self._done(f)
+                    continue
+                if _transient(ex):
+                    # 数据库不可用, 其余目录也稍后重试
+                    print(f'[WATCH] database error, retry {len(batch) - j} folders later: {ex}')
+                    for rest in batch[j:]:
+                        self._fail(rest, ex, now)
+                    break
+                self._fail(f, ex, now)
+        self.ingested += count
+        return count
+
+    def run(self, should_stop=None):
+        """loop until should_stop() is true (checked every poll seconds) or KeyboardInterrupt"""
+        self.start()
+        try:
+            while not (should_stop and should_stop()):
+                t = time.time()
+                folders = self.ready(t)
+                gone = self.gone(folders)
+                if folders or gone:
+                    self.ingest(folders, gone=gone)
+                time.sleep(max(self.poll - (time.time() - t), 0.05))
+        finally:
+            self.stop()